@@ -1,24 +1,405 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 
 import errno
+import hashlib
+import json
 import os
+import shutil
+import sqlite3
+import threading
+import time
 from . import _paths
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# Files that manage the cache itself are kept apart from cached artifacts
+INTERNAL_DIR = '.art'
+
+# A lock on a cached file that wasn't refreshed for this many seconds is
+# taken over, its holder is assumed to be gone
+STALE_LOCK_TIMEOUT = 300
+LOCK_POLL_INTERVAL = 0.5
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+_metadata = None
+_metadata_guard = threading.Lock()
+
+# Size of archive members extracted since the index was last updated
+_extracted = {}
+_extracted_guard = threading.Lock()
+
 
 def cache_path(filename):
     return os.path.join(_paths.cache_dir, filename)
 
+def internal_path(filename):
+    return os.path.join(_paths.cache_dir, INTERNAL_DIR, filename)
+
+def object_path(digest):
+    """Get the path of a file in the content-addressed store"""
+    return internal_path(os.path.join('objects', digest[:2], digest))
+
+def tree_path(filename, member=''):
+    """Get the path of an extracted member of a cached archive"""
+    return internal_path(os.path.join('tree', filename, member))
+
+def zip_index_path(filename):
+    """Get the path of the member index of a cached ZIP archive"""
+    return internal_path(os.path.join('zipindex', filename))
+
+def lock_path(filename):
+    return internal_path(os.path.join('locks', filename + '.lock'))
+
+def _tmp_path(path):
+    """Get a temporary file name for path that no other process or thread uses"""
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+def _remove_tmp(path_tmp):
+    """Remove a temporary file left by a failed write, without hiding the failure"""
+    try:
+        os.remove(path_tmp)
+    except OSError:
+        pass
+
+
+class HashingWriter():
+    """A writable stream wrapper that computes the SHA-256 of the written data"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._stream.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def load(self):
+        """Account for the data already in the stream, to append to it"""
+        self._stream.seek(0)
+        for block in iter(lambda: self._stream.read(1024 * 1024), b''):
+            self._hash.update(block)
+            self.size += len(block)
+
+    def restart(self):
+        """Discard the data written so far"""
+        self._stream.seek(0)
+        self._stream.truncate()
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+
+def _hash_file(path):
+    """Compute the SHA-256 of a file"""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def _is_stored(obj, digest, size):
+    """Check that a stored file exists and still has the given content"""
+    try:
+        return os.path.getsize(obj) == size and _hash_file(obj) == digest
+    except FileNotFoundError:
+        return False
+
+def _store(path_tmp, digest):
+    """
+    Deduplicate a new file using the content-addressed store
+
+    The file is hard linked into the store, or replaced by a hard link to the
+    stored file when the same content was saved before. A stored file that was
+    changed in place since is replaced by the new file. The file is kept as-is
+    if the filesystem doesn't support hard links.
+    """
+    obj = object_path(digest)
+    _paths.mkdirs(os.path.dirname(obj))
+    try:
+        if _is_stored(obj, digest, os.path.getsize(path_tmp)):
+            os.link(obj, path_tmp + '.link')
+            os.replace(path_tmp + '.link', path_tmp)
+        else:
+            obj_tmp = _tmp_path(obj)
+            os.link(path_tmp, obj_tmp)
+            os.replace(obj_tmp, obj)
+    except OSError:
+        pass
+
 @contextmanager
-def save_file(filename):
+def _index():
+    """
+    Open the index of cached files
+
+    The index records the project, source, size, inode, modification time,
+    SHA-256 and last access time of every cached file, and the size of its
+    extracted members. It is created from the files on disk when missing.
+    """
+    path = internal_path('index.sqlite')
+    exists = os.path.isfile(path)
+    _paths.mkdirs(os.path.dirname(path))
+
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                project TEXT NOT NULL,
+                source TEXT,
+                size INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                sha256 TEXT,
+                accessed REAL NOT NULL,
+                extracted INTEGER NOT NULL DEFAULT 0,
+                mtime INTEGER)''')
+            # indexes created by older versions lack the modification time
+            columns = [column[1] for column in conn.execute('PRAGMA table_info(files)')]
+            if 'mtime' not in columns:
+                conn.execute('ALTER TABLE files ADD COLUMN mtime INTEGER')
+            if not exists:
+                _scan(conn)
+        yield conn
+    finally:
+        conn.close()
+
+def _scan(conn):
+    """Fill the index from the files in the cache directory"""
+    # the content of a file is known if it's linked to the content-addressed store
+    digests = {}
+    for basepath, _, files in os.walk(internal_path('objects')):
+        for file in files:
+            digests[os.stat(os.path.join(basepath, file)).st_ino] = file
+
+    conn.execute('DELETE FROM files')
+    for basepath, dirs, files in os.walk(_paths.cache_dir):
+        if basepath == _paths.cache_dir and INTERNAL_DIR in dirs:
+            dirs.remove(INTERNAL_DIR)
+
+        for file in files:
+            if file.endswith('.tmp'):
+                continue
+
+            path = os.path.join(basepath, file)
+            name = os.path.relpath(path, _paths.cache_dir)
+            st = os.stat(path)
+            extracted = 0
+            for treepath, _, members in os.walk(tree_path(name)):
+                extracted += sum(os.path.getsize(os.path.join(treepath, member)) for member in members)
+
+            conn.execute('''INSERT INTO files (name, project, source, size, inode, mtime, sha256, accessed, extracted)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (name, os.path.dirname(name), _guess_source(file), st.st_size, st.st_ino,
+                 st.st_mtime_ns, digests.get(st.st_ino), st.st_atime, extracted))
+
+def _guess_source(file):
+    """Get the artifact source from the name of a file cached by "art" """
+    if file.startswith('repo-'):
+        return 'repository'
+    elif file.startswith('pkg-'):
+        return 'generic-package'
+    return 'ci-job'
+
+def rebuild_index():
+    """Recreate the index from the files on disk, e.g. after they were changed by hand"""
+    with _index() as conn:
+        with conn:
+            _scan(conn)
+
+@contextmanager
+def save_file(filename, source=None, resume=False):
+    """
+    Write a file to the cache
+
+    The file is written to a temporary file first, which is removed if
+    writing fails. With resume, it's kept instead, and writing appends to the
+    temporary file left by an earlier attempt, whose size is given by the
+    `size` of the writer. That file has a fixed name, so resumed writes must
+    hold the lock() of the file.
+    """
     path = cache_path(filename)
-    path_tmp = path + '.tmp'
+    path_tmp = path + '.tmp' if resume else _tmp_path(path)
     _paths.mkdirs(os.path.dirname(path))
-    with open(path_tmp, 'wb') as stream:
-        yield stream
-    os.rename(path_tmp, path)
+    try:
+        with open(path_tmp, 'a+b' if resume else 'wb') as stream:
+            writer = HashingWriter(stream)
+            if resume:
+                writer.load()
+            yield writer
+    except BaseException:
+        if not resume:
+            _remove_tmp(path_tmp)
+        raise
+    digest = writer.hexdigest()
+    _store(path_tmp, digest)
+    os.replace(path_tmp, path)
+
+    st = os.stat(path)
+    with _index() as conn:
+        with conn:
+            conn.execute('''INSERT OR REPLACE INTO files (name, project, source, size, inode, mtime, sha256, accessed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                (filename, os.path.dirname(filename), source, st.st_size,
+                 st.st_ino, st.st_mtime_ns, digest, time.time()))
+
+
+@contextmanager
+def save_tree_file(filename, member):
+    """Write an extracted member of a cached archive"""
+    path = tree_path(filename, member)
+    path_tmp = _tmp_path(path)
+    _paths.mkdirs(os.path.dirname(path))
+    try:
+        with open(path_tmp, 'wb') as stream:
+            yield stream
+    except BaseException:
+        _remove_tmp(path_tmp)
+        raise
+    os.replace(path_tmp, path)
+
+    with _extracted_guard:
+        _extracted[filename] = _extracted.get(filename, 0) + os.path.getsize(path)
+
+
+def flush():
+    """Record the size of newly extracted members in the index"""
+    with _extracted_guard:
+        extracted = _extracted.copy()
+        _extracted.clear()
+
+    if extracted:
+        with _index() as conn:
+            with conn:
+                conn.executemany('UPDATE files SET extracted = extracted + ? WHERE name = ?',
+                                 [(size, filename) for filename, size in extracted.items()])
+
+
+def _try_lock(fd):
+    """Take an advisory lock on an open file without waiting"""
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+def _unlock(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    elif msvcrt:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+def _is_open(fd, path):
+    """Check that an open lock file is still the one at path"""
+    try:
+        return os.stat(path).st_ino == os.fstat(fd).st_ino
+    except FileNotFoundError:
+        return False
+
+def _lock_file(path, waiting, blocking=True):
+    """
+    Open and lock the file at path, taking it over from a stale holder
+
+    Without blocking, None is returned if the file is locked.
+    """
+    _paths.mkdirs(os.path.dirname(path))
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            while not _try_lock(fd):
+                if not blocking:
+                    os.close(fd)
+                    return None
+                if waiting:
+                    waiting()
+                    waiting = None
+                if not _is_open(fd, path):
+                    break
+                if time.time() - os.fstat(fd).st_mtime > STALE_LOCK_TIMEOUT:
+                    # the stale holder keeps its lock, on a file nobody else opens
+                    try:
+                        os.remove(path)
+                        break
+                    except OSError:
+                        pass
+                time.sleep(LOCK_POLL_INTERVAL)
+            else:
+                # the holder removes the file when done, waiters start over with a new one
+                if _is_open(fd, path):
+                    os.utime(path)
+                    return fd
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+def _heartbeat(path, stop):
+    """Refresh a lock file while it's held, so that it isn't taken for stale"""
+    while not stop.wait(STALE_LOCK_TIMEOUT / 10):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+@contextmanager
+def lock(filename, waiting=None, blocking=True):
+    """
+    Serialize access to a cached file between threads and processes
+
+    Processes sharing the cache take an advisory lock on a file in the
+    `locks` directory, so that a single one downloads a missing artifact
+    while the others wait for it. `waiting` is called if the file is locked
+    by another process. Without blocking, the lock is only taken if nobody
+    holds it. The context value tells whether it was taken.
+    """
+    with _locks_guard:
+        file_lock = _locks.setdefault(filename, threading.Lock())
+    if not file_lock.acquire(blocking):
+        yield False
+        return
+
+    try:
+        path = lock_path(filename)
+        fd = _lock_file(path, waiting, blocking)
+        if fd is None:
+            yield False
+            return
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(path, stop), daemon=True)
+        heartbeat.start()
+        try:
+            yield True
+        finally:
+            stop.set()
+            heartbeat.join()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            _unlock(fd)
+            os.close(fd)
+    finally:
+        file_lock.release()
 
 
 def save(filename, content):
@@ -26,13 +407,26 @@ def save(filename, content):
         f.write(content)
 
 
+def _touch(filename):
+    """Record an access to a cached file for least-recently-used eviction"""
+    with _index() as conn:
+        with conn:
+            conn.execute('UPDATE files SET accessed = ? WHERE name = ?', (time.time(), filename))
+
+
 def contains(filename):
-    return os.path.isfile(cache_path(filename))
+    path = cache_path(filename)
+    if not os.path.isfile(path):
+        return False
+
+    _touch(filename)
+    return True
 
 
 def get(filename):
+    path = cache_path(filename)
     try:
-        return open(cache_path(filename), 'rb')
+        stream = open(path, 'rb')
     except IOError as exc:
         # translate "No such file or directory" into KeyError
         if exc.errno == errno.ENOENT:
@@ -40,16 +434,179 @@ def get(filename):
         else:
             raise
 
+    _touch(filename)
+    return stream
+
+def digest(filename):
+    """
+    Get the SHA-256 of a cached file, or None if it isn't cached
+
+    The digest recorded in the index is trusted as long as the inode, size and
+    modification time of the file still match, so that unchanged files are
+    only read once.
+    """
+    path = cache_path(filename)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    with _index() as conn:
+        row = conn.execute('SELECT inode, size, mtime, sha256 FROM files WHERE name = ?', (filename,)).fetchone()
+    if row and row[3] and row[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+        return row[3]
+
+    file_digest = _hash_file(path)
+
+    # content changed in place also changed the stored content it was linked to
+    if row and row[3] and row[3] != file_digest:
+        obj = object_path(row[3])
+        if os.path.isfile(obj) and os.path.samefile(obj, path):
+            os.remove(obj)
+
+    with _index() as conn:
+        with conn:
+            if row:
+                conn.execute('''UPDATE files SET size = ?, inode = ?, mtime = ?, sha256 = ? WHERE name = ?''',
+                    (st.st_size, st.st_ino, st.st_mtime_ns, file_digest, filename))
+            else:
+                conn.execute('''INSERT INTO files (name, project, source, size, inode, mtime, sha256, accessed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                    (filename, os.path.dirname(filename), _guess_source(os.path.basename(filename)),
+                     st.st_size, st.st_ino, st.st_mtime_ns, file_digest, time.time()))
+
+    return file_digest
+
+
+def _read_metadata():
+    global _metadata
+
+    if _metadata is None:
+        try:
+            with open(internal_path('metadata.json'), 'r') as stream:
+                _metadata = json.load(stream)
+        except (OSError, ValueError):
+            _metadata = {}
+
+    return _metadata
+
+
+def load_metadata(key, ttl):
+    """Get a value stored by save_metadata less than ttl seconds ago, or None"""
+    with _metadata_guard:
+        record = _read_metadata().get(key)
+
+    if record and time.time() - record['time'] < ttl:
+        return record['value']
+
+    return None
+
+
+def save_metadata(key, value):
+    """Persist a JSON-serializable value, like the result of an API lookup"""
+    with _metadata_guard:
+        metadata = _read_metadata()
+        metadata[key] = { 'value': value, 'time': time.time() }
+
+        path = internal_path('metadata.json')
+        _paths.mkdirs(os.path.dirname(path))
+        path_tmp = _tmp_path(path)
+        with open(path_tmp, 'w') as stream:
+            json.dump(metadata, stream)
+        os.replace(path_tmp, path)
+
+
 def list():
+    """
+    Find the cached artifacts of each project
+
+    The "size" of a project adds up the size of all its artifacts, while
+    "disk" counts identical artifacts stored in the same file only once and
+    includes their extracted members.
+    """
     archives = {}
-    for basepath, _, files in os.walk(_paths.cache_dir):
-        for file in files:
-            project = basepath.removeprefix(_paths.cache_dir).lstrip('/')
-            if project not in archives:
-                archives[project] = { 'files': [], 'size': 0 }
+    with _index() as conn:
+        rows = conn.execute('SELECT project, name, size, inode, extracted FROM files ORDER BY name').fetchall()
 
-            archive_path = os.path.join(basepath, file)
-            archives[project]['files'].append(archive_path)
-            archives[project]['size'] += os.path.getsize(archive_path)
+    inodes = {}
+    for project, name, size, inode, extracted in rows:
+        if project not in archives:
+            archives[project] = { 'files': [], 'size': 0, 'disk': 0 }
+            inodes[project] = set()
+
+        archives[project]['files'].append(name)
+        archives[project]['size'] += size
+        archives[project]['disk'] += extracted
+        if inode not in inodes[project]:
+            inodes[project].add(inode)
+            archives[project]['disk'] += size
 
     return archives
+
+
+def disk_usage():
+    """Get the disk space used by cached artifacts, counting shared files once"""
+    with _index() as conn:
+        rows = conn.execute('SELECT inode, MAX(size) + SUM(extracted) FROM files GROUP BY inode').fetchall()
+
+    return sum(size for _, size in rows)
+
+
+def remove(filename):
+    """Remove a cached file and its extracted members"""
+    _paths.remove(cache_path(filename))
+    _paths.remove(zip_index_path(filename))
+    shutil.rmtree(tree_path(filename), ignore_errors=True)
+    with _index() as conn:
+        with conn:
+            conn.execute('DELETE FROM files WHERE name = ?', (filename,))
+
+
+def collect(max_size=None, max_age=None, dry_run=False):
+    """
+    Evict the least recently used artifacts
+
+    Artifacts are removed until the cache uses at most max_size bytes, and
+    artifacts unused for more than max_age seconds are removed regardless.
+    Artifacts that share their content are evicted together. Artifacts locked
+    by another thread or process, e.g. while they're installed, are skipped.
+
+    Returns the list of removed (project, filename) pairs.
+    """
+    with _index() as conn:
+        rows = conn.execute('''SELECT inode, MAX(size) + SUM(extracted), MAX(accessed), GROUP_CONCAT(name, '\n')
+            FROM files GROUP BY inode ORDER BY MAX(accessed)''').fetchall()
+
+    now = time.time()
+    total = sum(size for _, size, _, _ in rows)
+    removed = []
+    for _, size, accessed, names in rows:
+        expired = max_age is not None and now - accessed > max_age
+        oversize = max_size is not None and total > max_size
+        if not expired and not oversize:
+            break
+
+        filenames = names.split('\n')
+        if not dry_run:
+            with ExitStack() as stack:
+                if not all(stack.enter_context(lock(filename, blocking=False)) for filename in filenames):
+                    continue
+                for filename in filenames:
+                    remove(filename)
+
+        removed.extend((os.path.dirname(filename), filename) for filename in filenames)
+        total -= size
+
+    if not dry_run:
+        prune()
+
+    return removed
+
+
+def prune():
+    """Remove stored content that is no longer linked to any cached artifact"""
+    for basepath, _, files in os.walk(internal_path('objects')):
+        for file in files:
+            path = os.path.join(basepath, file)
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
@@ -3,6 +3,7 @@
 from __future__ import absolute_import
 
 import os
+import time
 
 import click
 
@@ -17,6 +18,43 @@ class ConfigException(click.ClickException):
         msg = 'config.{}: {}'.format(config_key, message)
         super().__init__(msg)
 
+SIZE_UNITS = { '': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+DURATION_UNITS = { '': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+
+def _parse_quantity(value, units):
+    text = str(value).strip()
+    number = text.rstrip(''.join(units))
+    unit = text[len(number):]
+    try:
+        return int(float(number) * units[unit])
+    except (KeyError, ValueError):
+        expected = ', '.join(unit for unit in units if unit)
+        raise ValueError('"%s" is not a number with an optional unit (%s)' % (value, expected)) from None
+
+def parse_size(value):
+    """Convert a size like "20G" or "512M" to bytes"""
+    return _parse_quantity(str(value).upper(), SIZE_UNITS)
+
+def parse_duration(value):
+    """Convert a duration like "30d" or "12h" to seconds"""
+    return _parse_quantity(value, DURATION_UNITS)
+
+def cache_budget(config):
+    """
+    Get the (max_size, max_age) limits of the artifact cache from the config
+
+    Either value is None when not configured.
+    """
+    budget = []
+    for key, parse in (('cache_max_size', parse_size), ('cache_max_age', parse_duration)):
+        value = config.get(key, None)
+        try:
+            budget.append(None if value is None else parse(value))
+        except ValueError as exc:
+            raise ConfigException(key, str(exc)) from exc
+
+    return tuple(budget)
+
 def save(gitlab_url, token_type, token_or_client_id):
     config = {
             "gitlab_url": gitlab_url,
@@ -24,7 +62,7 @@ def save(gitlab_url, token_type, token_or_client_id):
         }
     if token_type == 'oauth':
         config['oauth_client_id'] = token_or_client_id
-        config['token'], config['refresh_token'] = _oauth.authorize(gitlab_url, token_or_client_id)
+        config['token'], config['refresh_token'], config['token_expires_at'] = _oauth.authorize(gitlab_url, token_or_client_id)
     else:
         config['token'] = token_or_client_id
 
@@ -57,7 +95,7 @@ def migrate(config):
 
 def refresh_token(config):
     """Use the OAuth refresh token to update an expired access token"""
-    access_token, refresh_token = _oauth.refresh(
+    access_token, refresh_token, expires_at = _oauth.refresh(
         config["gitlab_url"],
         config["oauth_client_id"],
         config["refresh_token"])
@@ -66,10 +104,28 @@ def refresh_token(config):
     if refresh_token:
         config["token"] = access_token
         config["refresh_token"] = refresh_token
+        config["token_expires_at"] = expires_at
         write(config)
 
     return access_token
 
+# OAuth access tokens are refreshed when they expire within this many seconds
+TOKEN_EXPIRY_MARGIN = 60
+
+def token_expired(config):
+    """
+    Determine if the OAuth access token expired, according to the expiry
+    time saved with it
+
+    Tokens saved by older versions have no expiry time and are assumed to be
+    valid. The server rejects them if they aren't.
+    """
+    expires_at = config.get('token_expires_at', None)
+    if expires_at is None:
+        return False
+
+    return time.time() > expires_at - TOKEN_EXPIRY_MARGIN
+
 def validate(config):
     """Ensure the configuration meets expectations"""
     required_fields = ('token', 'token_type', 'gitlab_url')
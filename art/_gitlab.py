@@ -2,55 +2,380 @@
 from __future__ import absolute_import
 
 import contextlib
+import random
+import re
+import threading
+from urllib.parse import quote
 
 import click
 import requests
+import requests.adapters
+import urllib3.util
 from gitlab import exceptions as GitlabExceptions
 from gitlab import Gitlab
 
+from . import _cache
 from . import _config
+from . import _parallel
+from . import _termui
+from . import _timings
 
-def get():
+# urllib3 keeps 10 connections per host unless told otherwise
+DEFAULT_POOL_SIZE = 10
+
+# Results of API lookups, shared by all entries during a run
+_memo = {}
+_memo_guard = threading.Lock()
+
+# Lookups whose answer cannot change are also kept in the cache directory
+# for this many seconds. Set from the "metadata_cache_ttl" config setting.
+metadata_ttl = 0
+
+# Requests answered with these statuses, or that fail to connect, are retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+BACKOFF_MAX = 60
+
+# Number of requests retried during the run
+retries = 0
+_retries_guard = threading.Lock()
+
+def count_retry(reason, pushback=False):
+    """
+    Record a retried request. A server that pushes back, e.g. with "429 Too Many
+    Requests", also lowers the number of entries processed at once.
+    """
+    global retries
+
+    with _retries_guard:
+        retries += 1
+    _timings.count('retries')
+    _termui.echo('* %s, retrying...' % reason, err=True)
+
+    if pushback:
+        _parallel.congestion()
+
+def backoff_time(attempt):
+    """Get the delay before the given retry attempt, with jitter"""
+    delay = min(BACKOFF_FACTOR * (2 ** (attempt - 1)), BACKOFF_MAX)
+    # jitter keeps the workers that failed together from retrying together
+    return delay * random.uniform(0.5, 1.0)
+
+class RetryPolicy(urllib3.util.Retry):
+    """
+    Retry requests with exponential backoff and jitter, or after the delay
+    given by the Retry-After header of the response
+    """
+
+    def get_backoff_time(self):
+        return min(super().get_backoff_time(), BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        retry = super().increment(method, url, response, error, *args, **kwargs)
+
+        if response is not None:
+            pushback = response.status in (429, 503) or 'Retry-After' in response.headers
+            count_retry('GitLab answered %d %s' % (response.status, response.reason), pushback)
+        else:
+            count_retry('Request to GitLab failed: %s' % (error,))
+
+        return retry
+
+def session(pool_size=None, max_retries=DEFAULT_MAX_RETRIES):
+    """
+    Create a requests session that keeps enough connections alive for
+    `pool_size` concurrent requests to the GitLab server
+
+    Requests that fail to connect or get an error that may be transient are
+    retried up to max_retries times.
+    """
+    pool_size = max(pool_size or 0, DEFAULT_POOL_SIZE)
+    http = requests.Session()
+    retry = RetryPolicy(total=max_retries, status_forcelist=RETRY_STATUSES, backoff_factor=BACKOFF_FACTOR)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    http.hooks['response'].append(lambda response, **kwargs: _timings.count('api_requests'))
+    return http
+
+def get(pool_size=None):
     """
     Create a GitLab API object from the current configuration
+
+    All requests, including artifact downloads, share one connection pool
+    sized for `pool_size` worker threads.
     """
+    global metadata_ttl
 
     config = _config.load()
+    metadata_ttl = config.get('metadata_cache_ttl', 0)
     gitlab_url = config['gitlab_url']
     token = config['token']
+    http = session(pool_size, config.get('max_retries', DEFAULT_MAX_RETRIES))
     if config['token_type'] == 'private':
-        return Gitlab(gitlab_url, private_token=token)
+        return Gitlab(gitlab_url, private_token=token, session=http)
     if config['token_type'] == 'job':
-        return Gitlab(gitlab_url, job_token=token)
+        return Gitlab(gitlab_url, job_token=token, session=http)
     if config['token_type'] == 'oauth':
-        gitlab = Gitlab(gitlab_url, oauth_token=token)
-
-        # OAuth tokens are only valid for 2 hours. Verify that the stored
-        # token isn't expired
-        if token and test_token(gitlab):
-            return gitlab
+        # OAuth tokens are only valid for 2 hours. Refresh the stored token
+        # if it expired, rather than asking the server whether it's valid.
+        if not token or _config.token_expired(config):
+            token = _config.refresh_token(config)
 
-        # If expired, use the refresh token to get a new one
-        token = _config.refresh_token(config)
-        return Gitlab(gitlab_url, oauth_token=token)
+        gitlab = Gitlab(gitlab_url, oauth_token=token, session=http)
+        http.hooks['response'].append(_oauth_refresh_hook(gitlab, config))
+        return gitlab
 
     raise _config.ConfigException('token_type', 'Unknown token type: {}'.format(config['token_type']))
 
-# Try to use the authentication token
-def test_token(gitlab):
+def _oauth_refresh_hook(gitlab, config):
+    """
+    Create a response hook that refreshes an OAuth token rejected by the
+    server, like a token that was revoked or saved without its expiry time
+
+    The token is refreshed at most once per run, and the rejected request
+    is sent again with the new token.
+    """
+    guard = threading.Lock()
+    refreshed = []
+
+    def hook(response, **kwargs):
+        if response.status_code != 401:
+            return None
+
+        with guard:
+            sent = response.request.headers.get('Authorization', None)
+            if sent == 'Bearer {}'.format(gitlab.oauth_token):
+                if refreshed:
+                    return None
+
+                refreshed.append(True)
+                token = _config.refresh_token(config)
+                if not token:
+                    return None
+
+                gitlab.oauth_token = token
+                gitlab._set_auth_info()
+
+            retry = response.request.copy()
+            retry.headers['Authorization'] = 'Bearer {}'.format(gitlab.oauth_token)
+
+        # release the connection for the retry
+        response.content
+        response.close()
+        retried = response.connection.send(retry, **kwargs)
+        retried.history.append(response)
+        return retried
+
+    return hook
+
+def artifact_url(gitlab, entry):
+    """Get the API URL that downloads the artifact file of a lock entry"""
+    source = entry.get('source', 'ci-job')
+    project = quote(str(entry['project']), safe='')
+
+    if source == 'ci-job':
+        path = '/projects/{}/jobs/{}/artifacts'.format(project, entry['job_id'])
+    elif source == 'repository':
+        path = '/projects/{}/repository/archive.zip?sha={}'.format(project, entry['commit'])
+    elif source == 'generic-package':
+        path = '/projects/{}/packages/generic/{}/{}/{}'.format(
+            project,
+            quote(entry['package'], safe=''),
+            quote(str(entry['ref']), safe=''),
+            quote(entry['filename'], safe=''))
+
+    return gitlab.api_url + path
+
+def request(gitlab, url, headers=None):
+    """
+    Send a streamed GET request with the credentials of a GitLab API object
+
+    This is used for downloads that need request headers python-gitlab can't
+    send, like Range. HTTP errors raise the matching python-gitlab exception.
+    """
+    opts = gitlab._get_session_opts()
+    opts['headers'].update(headers or {})
+    response = gitlab.session.get(url, stream=True, **opts)
+
+    if response.status_code >= 400:
+        response.close()
+        if response.status_code == 401:
+            raise GitlabExceptions.GitlabAuthenticationError(response.reason, response.status_code)
+        raise GitlabExceptions.GitlabGetError(response.reason, response.status_code)
+
+    return response
+
+class IncompleteDownload(requests.exceptions.ConnectionError):
+    """Raised when a download ended before all announced bytes were received"""
+
+# Errors after which a download can be resumed
+TRANSFER_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+    )
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def _resume(gitlab, url, headers, offset):
+    """
+    Request the rest of a file after its first `offset` bytes
+
+    Returns the response and the size of the whole file, or (None, None) if
+    the server can't continue from offset.
+    """
+    try:
+        response = request(gitlab, url, dict(headers, Range='bytes=%d-' % offset))
+    except GitlabExceptions.GitlabGetError as exc:
+        # 416 Range Not Satisfiable: the partial file is larger than the remote file
+        if exc.response_code == 416:
+            return None, None
+        raise
+
+    content_range = re.fullmatch(r'bytes (\d+)-\d+/(\d+)', response.headers.get('Content-Range', ''))
+    if response.status_code == 206 and content_range:
+        start, size = int(content_range.group(1)), int(content_range.group(2))
+        if start == offset < size:
+            return response, size
+
+    response.close()
+    return None, None
+
+def download(gitlab, url, fileobj, resume=True):
     """
-    Use GitLab's auth API endpoint to check for a valid access token
+    Download url to fileobj, a cache file writer
 
-    Returns True if the token can be used access the API.
+    With resume, the download continues after the `fileobj.size` bytes already
+    written, if the server supports range requests. Otherwise it starts over.
+    Returns True if the download continued.
     """
-    with wrap_errors(gitlab, "Authentication failed"):
+    # identity encoding makes Content-Length the size of the file itself
+    headers = {'Accept-Encoding': 'identity'}
+
+    response = None
+    if resume and fileobj.size:
+        response, expected_size = _resume(gitlab, url, headers, fileobj.size)
+    resumed = response is not None
+
+    if response is None:
+        fileobj.restart()
+        response = request(gitlab, url, headers)
+        content_length = response.headers.get('Content-Length', None)
+        expected_size = int(content_length) if content_length else None
+
+    with response:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            fileobj.write(chunk)
+            _timings.count('bytes_downloaded', len(chunk))
+
+    if expected_size is not None and fileobj.size != expected_size:
+        raise IncompleteDownload('Received %d of %d bytes from %s' % (fileobj.size, expected_size, url))
+
+    return resumed
+
+def _memoize(key, lookup):
+    """
+    Call lookup once per key and run. Concurrent callers with the same key
+    wait for the first result rather than repeating the request.
+    """
+    with _memo_guard:
+        memo = _memo.setdefault(key, {'lock': threading.Lock()})
+
+    with memo['lock']:
+        if 'value' not in memo:
+            memo['value'] = lookup()
+        return memo['value']
+
+def is_commit_id(ref):
+    """Determine if a git ref is a full commit id"""
+    return re.fullmatch('[0-9a-f]{40}', ref) is not None
+
+def get_project(gitlab, path):
+    """Get a project, requesting it from the server once per run"""
+    return _memoize(('project', path), lambda: gitlab.projects.get(path))
+
+def get_commit(project, ref):
+    """
+    Resolve a git ref of a project to a commit id
+
+    Tags and commit ids are not expected to move. When the metadata cache is
+    enabled, the commit they resolve to is saved for later runs. Other refs,
+    like branches, are remembered not to be tags, so later runs resolve them
+    without looking for a tag first.
+    """
+    def lookup():
+        if not metadata_ttl:
+            return project.commits.get(ref).id
+
+        key = 'commit:{}:{}'.format(project.id, ref)
+        commit = _cache.load_metadata(key, metadata_ttl)
+        if commit:
+            return commit
+
+        untagged_key = 'untagged:{}:{}'.format(project.id, ref)
+        if is_commit_id(ref):
+            commit = project.commits.get(ref).id
+        elif _cache.load_metadata(untagged_key, metadata_ttl):
+            return project.commits.get(ref).id
+        else:
+            try:
+                commit = project.tags.get(ref).commit['id']
+            except GitlabExceptions.GitlabGetError as exc:
+                if exc.response_code != 404:
+                    raise
+                # not a tag; branches move, so only that is saved
+                _cache.save_metadata(untagged_key, True)
+                return project.commits.get(ref).id
+
+        _cache.save_metadata(key, commit)
+        return commit
+
+    return _memoize(('commit', project.id, ref), lookup)
+
+def _find_package_file(gitlab, project, package, version, filename):
+    fail_msg = 'Failed to get package "%s" version "%s" for "%s"' % (package, version, project)
+    with wrap_errors(gitlab, fail_msg):
+        proj = get_project(gitlab, project)
+        packages = proj.packages.list(package_type='generic', package_name=package, package_version=version, get_all=True)
+
+    if len(packages) != 1:
+        raise click.ClickException('More than 1 package with name "%s" version "%s" for "%s"' % (package, version, project))
+
+    fail_msg = 'Failed to get file "%s" in package "%s" version "%s" for "%s"' % (filename, package, version, project)
+    with wrap_errors(gitlab, fail_msg):
+        files = packages[0].package_files.list(get_all=True)
         try:
-            gitlab.auth()
-            return True
-        except GitlabExceptions.GitlabAuthenticationError:
-            pass
+            file = next(f for f in files if f.file_name == filename)
+        except StopIteration as exc:
+            raise click.ClickException(fail_msg) from exc
 
-    return False
+    # older GitLab versions may not report the checksum
+    return packages[0].id, file.id, getattr(file, 'file_sha256', None)
+
+def get_package_file(gitlab, project, package, version, filename):
+    """
+    Find a file of a generic package version
+
+    Returns a (package_id, package_file_id, sha256) tuple. When the metadata
+    cache is enabled, it is saved for later runs.
+    """
+    key = 'package:{}:{}:{}:{}'.format(project, package, version, filename)
+
+    def lookup():
+        if metadata_ttl:
+            ids = _cache.load_metadata(key, metadata_ttl)
+            # entries saved by older versions lack the checksum
+            if ids and len(ids) == 3:
+                return tuple(ids)
+
+        ids = _find_package_file(gitlab, project, package, version, filename)
+        if metadata_ttl:
+            _cache.save_metadata(key, ids)
+        return ids
+
+    return _memoize(key, lookup)
 
 @contextlib.contextmanager
 def wrap_errors(gitlab, fail_msg=None):
@@ -59,7 +384,15 @@ def wrap_errors(gitlab, fail_msg=None):
         yield
     except requests.exceptions.SSLError as exc:
         raise click.ClickException('TLS connection to %s failed: %s' % (gitlab.url, exc))
-    except requests.exceptions.ConnectionError as exc:
+    except requests.exceptions.RetryError as exc:
+        # the reason of the urllib3 MaxRetryError, like "too many 503 error responses"
+        reason = getattr(exc.args[0], 'reason', exc) if exc.args else exc
+        msg = 'GitLab at %s kept failing, gave up retrying: %s' % (gitlab.url, reason)
+        if fail_msg:
+            msg = '%s: %s' % (fail_msg, msg)
+
+        raise click.ClickException(msg)
+    except TRANSFER_ERRORS as exc:
         raise click.ClickException('Connection to %s failed: %s' % (gitlab.url, exc))
     except GitlabExceptions.GitlabAuthenticationError as exc:
         raise click.ClickException('GitLab authentication failed: %s' % exc)
@@ -2,13 +2,18 @@
 
 from __future__ import absolute_import
 
+import json
 import os
 import shutil
 import stat
+import zipfile
+import zlib
 import click
 
 from . import _cache
 from . import _paths
+from . import _timings
+from . import _zipindex
 
 UMASK_VALUE = -1
 def _get_umask():
@@ -112,24 +117,174 @@ class InstallAction():
         return '{} => {}'.format(self.src, self.dest)
 
 
-def _source_from_archive(archive, filepath):
+class InstallActionIndex():
     """
-    Open the file, identified by filepath, within a ZIP archive
+    Finds the install actions that match archive paths
+
+    Rather than testing every action, matching looks up the path itself and
+    each of its directory prefixes, so the cost grows with the depth of the
+    path instead of the number of install requests.
+    """
+
+    def __init__(self, actions):
+        self._all = []
+        self._files = {}
+        self._dirs = {}
+        for index, action in enumerate(actions):
+            if action.src == '.':
+                self._all.append((index, action))
+            elif action.src.endswith('/'):
+                self._dirs.setdefault(action.src, []).append((index, action))
+            else:
+                self._files.setdefault(action.src, []).append((index, action))
+
+        # directory prefixes longer than every directory request can't match
+        self._max_dir_len = max((len(src) for src in self._dirs), default=0)
+
+    def match(self, filepath):
+        """Get the actions that match an archive filepath, in their original order"""
+        matches = self._all + self._files.get(filepath, [])
+
+        end = filepath.find('/')
+        while end != -1 and end < self._max_dir_len:
+            matches += self._dirs.get(filepath[:end + 1], [])
+            end = filepath.find('/', end + 1)
+
+        if len(matches) > 1:
+            matches.sort(key=lambda match: match[0])
+        return [action for _, action in matches]
+
+
+def _split_common_suffix(source, target):
+    """
+    Split an archive path and its target into (source prefix, target prefix, path),
+    where path is their longest common suffix made of whole path components
     """
-    member = archive.getinfo(filepath)
+    source_parts = source.split('/')
+    target_parts = target.split('/')
+    common = 0
+    while (common < min(len(source_parts), len(target_parts))
+           and source_parts[-1 - common] == target_parts[-1 - common]):
+        common += 1
+
+    path = '/'.join(source_parts[len(source_parts) - common:])
+    return source[:len(source) - len(path)], target[:len(target) - len(path)], path
+
+def compact_files(files):
+    """
+    Encode the `files` list of a lock entry as `file_prefixes` records
+
+    Consecutive files installed from the same archive directory to the same
+    target directory are collapsed into one record holding both prefixes and
+    the paths under them. The order of the files is kept.
+    """
+    records = []
+    for file_spec in files:
+        source, target = next(iter(file_spec.items()))
+        source_prefix, target_prefix, path = _split_common_suffix(source, target)
+        if not records or (records[-1]['source'], records[-1]['target']) != (source_prefix, target_prefix):
+            records.append({ 'source': source_prefix, 'target': target_prefix, 'paths': [] })
+        records[-1]['paths'].append(path)
+
+    return records
 
+def expand_file_prefixes(records):
+    """Generate the (archive path, target) pairs encoded by compact_files"""
+    for record in records:
+        for path in record['paths']:
+            yield record['source'] + path, record['target'] + path
+
+
+def _member_mode(member):
+    """Get the file mode of a ZIP archive member"""
     # if create_system is Unix (3), external_attr contains filesystem permissions
     if member.create_system == 3:
-        filemode = member.external_attr >> 16
+        return member.external_attr >> 16
     elif member.is_dir():
-        filemode = (0o777 ^ _get_umask()) | stat.S_IFDIR
+        return (0o777 ^ _get_umask()) | stat.S_IFDIR
+    else:
+        return (0o666 ^ _get_umask()) | stat.S_IFREG
+
+
+def _stored_data_offset(artifact_file, member):
+    """
+    Get the offset of the data of an archive member stored without compression,
+    or None if the member is compressed or encrypted
+    """
+    if member.compress_type != zipfile.ZIP_STORED or member.flag_bits & 0x1:
+        return None
+
+    # reading the header must not move the artifact file shared by threads
+    if not hasattr(os, 'pread'):
+        return None
+
+    # the extra field of the local header may differ from the central directory
+    header = os.pread(artifact_file.fileno(), _zipindex.ZIP_LOCAL_HEADER.size, member.header_offset)
+    if len(header) != _zipindex.ZIP_LOCAL_HEADER.size:
+        return None
+
+    signature, name_length, extra_length = _zipindex.ZIP_LOCAL_HEADER.unpack(header)
+    if signature != b'PK\x03\x04':
+        return None
+
+    return member.header_offset + _zipindex.ZIP_LOCAL_HEADER.size + name_length + extra_length
+
+
+def _copy_member(artifact_file, archive, member, ftarget):
+    """
+    Write the content of an archive member to a file
+
+    Members stored without compression are copied straight from the artifact
+    file by the kernel.
+    """
+    offset = _stored_data_offset(artifact_file, member)
+    if offset is not None:
+        _paths.copy_range(artifact_file, ftarget, offset, member.compress_size)
     else:
+        with archive.open(member) as fsource:
+            shutil.copyfileobj(fsource, ftarget)
+
+
+def _is_contained(path):
+    """Determine if a relative path stays within its base directory"""
+    path = os.path.normpath(path)
+    return not os.path.isabs(path) and path != '..' and not path.startswith('..' + os.sep)
+
+
+def _link_from_tree(artifact_file, archive, archive_path, target, link_tree):
+    """
+    Install a file as a clone of its extracted copy in the cache
+
+    The archive member is extracted to the cache the first time it's needed.
+    An artifact that isn't extracted is cloned directly where the filesystem
+    supports reflinks. Otherwise it's copied to the cache first as well, as a
+    hard link to the artifact would share it with the content-addressed store.
+    """
+    if not archive:
+        if _paths.reflink_file(artifact_file.name, target):
+            return (0o666 ^ _get_umask()) | stat.S_IFREG
+        member = None
+        tree_member = os.path.basename(link_tree)
         filemode = (0o666 ^ _get_umask()) | stat.S_IFREG
+    else:
+        member = archive.getinfo(archive_path)
+        tree_member = archive_path
+        filemode = _member_mode(member)
+
+    cached = _cache.tree_path(link_tree, tree_member)
+    if not os.path.isfile(cached):
+        with _cache.save_tree_file(link_tree, tree_member) as fcached:
+            if member:
+                _copy_member(artifact_file, archive, member, fcached)
+            else:
+                _paths.copy_range(artifact_file, fcached, 0, os.fstat(artifact_file.fileno()).st_size)
+            _timings.count('bytes_written', fcached.tell())
 
-    return archive.open(member), filemode
+    _paths.clone_file(cached, target)
+    return filemode
 
 
-def install(artifact_file, archive, archive_path, target):
+def install(artifact_file, archive, archive_path, target, link_tree=None, copy_from=None):
     """Perform the install action on the artifact or a zip archive member
 
     If archive is spec
@@ -138,33 +293,126 @@ def install(artifact_file, archive, archive_path, target):
     archive       An optional zip archive for the artifact_file
     archive_path  The path within archive that identifies the file to install
     target        Destination file path
+    link_tree     Cache name of the artifact, to install files as reflinks or
+                  hard links of their extracted copy in the cache
+    copy_from     A file already installed from the same archive member, to
+                  copy instead of reading the member again
     """
 
-    fsource = None
-    try:
-        # If a ZIP archive is provided, obtain the source file using archive_path
-        # Otherwise the source file is the artifact itself
-        if archive:
-            fsource, filemode = _source_from_archive(archive, archive_path)
-        else:
-            fsource = artifact_file
-            filemode = (0o666 ^ _get_umask()) | stat.S_IFREG
-
-        # Keep only the normal permissions bits;
-        # ignore special bits like setuid, setgid, sticky
+    if link_tree and not target.endswith('/') and _is_contained(archive_path):
+        if os.sep in target:
+            _paths.mkdirs(os.path.dirname(target))
+        filemode = _link_from_tree(artifact_file, archive, archive_path, target, link_tree)
         access = filemode & InstallAction.S_IRWXUGO
-        filemode = stat.S_IFMT(filemode) | access
+        return target, stat.S_IFMT(filemode) | access
+
+    # If a ZIP archive is provided, the source file is identified by archive_path
+    # Otherwise the source file is the artifact itself
+    member = None
+    if archive:
+        member = archive.getinfo(archive_path)
+        filemode = _member_mode(member)
+    else:
+        filemode = (0o666 ^ _get_umask()) | stat.S_IFREG
 
-        if target.endswith('/'):
-            _paths.mkdirs(target)
-        else:
-            if os.sep in target:
-                _paths.mkdirs(os.path.dirname(target))
-            with open(target, 'wb') as ftarget:
-                shutil.copyfileobj(fsource, ftarget)
-    finally:
-        # Only close files we opened
-        if fsource != artifact_file:
-            fsource.close()
+    # Keep only the normal permissions bits;
+    # ignore special bits like setuid, setgid, sticky
+    access = filemode & InstallAction.S_IRWXUGO
+    filemode = stat.S_IFMT(filemode) | access
+
+    if target.endswith('/'):
+        _paths.mkdirs(target)
+    else:
+        if os.sep in target:
+            _paths.mkdirs(os.path.dirname(target))
+
+        # never write through a hard link into the cache
+        if os.path.isfile(target) and os.stat(target).st_nlink > 1:
+            os.remove(target)
+
+        with open(target, 'wb') as ftarget:
+            if copy_from:
+                with open(copy_from, 'rb') as fsource:
+                    _paths.copy_range(fsource, ftarget, 0, os.fstat(fsource.fileno()).st_size)
+            elif member:
+                _copy_member(artifact_file, archive, member, ftarget)
+            else:
+                _paths.copy_range(artifact_file, ftarget, 0, os.fstat(artifact_file.fileno()).st_size)
+            _timings.count('bytes_written', ftarget.tell())
 
     return target, filemode
+
+
+def load_state(path):
+    """
+    Load the install state of a lock file
+
+    The state maps each installed target to the artifact and archive path it
+    was installed from, and its size, modification time, mode and CRC-32.
+    """
+    try:
+        with open(path, 'r') as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        # an unreadable state only means that every file gets installed again
+        return {}
+
+
+def save_state(path, state):
+    try:
+        with open(path, 'w') as stream:
+            json.dump(state, stream)
+    except OSError as exc:
+        raise click.ClickException('Failed to write file: %s' % exc)
+
+
+def state_record(source, target, filemode, crc):
+    """Describe a freshly installed target for the install state"""
+    st = os.stat(target)
+    return {
+        'source': source,
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'mode': filemode,
+        'crc': crc,
+    }
+
+
+def _file_crc(path):
+    crc = 0
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(1024 * 1024), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def is_installed(record, source, target):
+    """Determine if target still holds the file recorded in the install state
+
+    Files whose modification time changed are compared by CRC-32, if known.
+    """
+    if not record or record['source'] != source:
+        return False
+
+    try:
+        st = os.stat(target)
+    except OSError:
+        return False
+
+    # archives don't always record the file type, only compare permissions
+    if stat.S_IMODE(st.st_mode) != stat.S_IMODE(record['mode']):
+        return False
+    if stat.S_ISDIR(st.st_mode):
+        return target.endswith('/')
+
+    if st.st_size != record['size']:
+        return False
+    if st.st_mtime_ns == record['mtime']:
+        return True
+    if record['crc'] is None or _file_crc(target) != record['crc']:
+        return False
+
+    record['mtime'] = st.st_mtime_ns
+    return True
@@ -26,6 +26,18 @@ def _check_response(response):
 
     return (status, None, None)
 
+def _token(status):
+    """
+    Get the (access_token, refresh_token, expires_at) tuple of a token response
+
+    expires_at is a Unix timestamp, or None if the server didn't report the
+    lifetime of the access token.
+    """
+    expires_in = status.get("expires_in", None)
+    expires_at = int(time.time()) + int(expires_in) if expires_in else None
+
+    return (status["access_token"], status["refresh_token"], expires_at)
+
 def _wait_for_token(gitlab_url, client_id, device_code, poll_interval):
     """
     Poll the OAuth token endpoint, waiting for the user to complete authorization
@@ -46,7 +58,7 @@ def _wait_for_token(gitlab_url, client_id, device_code, poll_interval):
         access_token = status.get("access_token", None)
         refresh_token = status.get("refresh_token", None)
         if access_token and refresh_token:
-            return (access_token, refresh_token)
+            return _token(status)
 
         if error == "authorization_pending":
             pass
@@ -54,10 +66,10 @@ def _wait_for_token(gitlab_url, client_id, device_code, poll_interval):
             poll_interval += 1
         elif error_description:
             print("Authentication failed:", error_description, "({})".format(error))
-            return (None, None)
+            return (None, None, None)
         else:
             print("Authentication failed:", error)
-            return (None, None)
+            return (None, None, None)
 
         time.sleep(poll_interval)
 
@@ -77,7 +89,7 @@ def authorize(gitlab_url, client_id):
         print("Authentication failed:", error)
         if error_description:
             print(error_description)
-        return (None, None)
+        return (None, None, None)
 
     print("Authentication is required.")
     print("Visit", status["verification_uri_complete"], "and verify this code:\n")
@@ -109,4 +121,4 @@ def refresh(gitlab_url, client_id, refresh_token):
         print("Authentication failed:", error)
         return authorize(gitlab_url, client_id)
 
-    return status["access_token"], status["refresh_token"]
+    return _token(status)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import concurrent.futures
+import threading
+import time
+
+from . import _termui
+
+# Seconds without pushback from the server before concurrency is raised again
+RECOVERY_DELAY = 5.0
+
+_limits = set()
+_limits_guard = threading.Lock()
+
+
+class _Limit():
+    """
+    The number of items processed at once by run()
+
+    The limit is halved when the server pushes back, and raised by one item
+    at a time once it stopped doing so, up to the number of jobs.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.limit = jobs
+        self._active = 0
+        self._changed = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            now = time.monotonic()
+            if self.limit < self.jobs and now - self._changed > RECOVERY_DELAY:
+                self.limit += 1
+                self._changed = now
+            self._condition.notify_all()
+
+    def reduce(self):
+        with self._condition:
+            # the workers that were already running report the same pushback
+            now = time.monotonic()
+            if self.limit > 1 and now - self._changed > 1.0:
+                self.limit = max(self.limit // 2, 1)
+                self._changed = now
+                _termui.echo('* server is busy, working on %d item(s) at a time' % self.limit, err=True)
+
+
+def congestion():
+    """Lower the concurrency of running run() calls because the server asked to slow down"""
+    with _limits_guard:
+        limits = list(_limits)
+
+    for limit in limits:
+        limit.reduce()
+
+
+def run(func, items, jobs=1):
+    """Apply func to every item using a pool of at most `jobs` threads
+
+    Returns a (result, exception) pair for each item, in the order of items.
+    Exceptions raised by func are captured rather than propagated so that
+    the caller can report the failure of every item. Fewer threads work at
+    once while the server pushes back, see congestion().
+    """
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as exc:
+            return None, exc
+
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    limit = _Limit(jobs)
+
+    def limited_call(item):
+        limit.acquire()
+        try:
+            return call(item)
+        finally:
+            limit.release()
+
+    with _limits_guard:
+        _limits.add(limit)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(limited_call, items))
+    finally:
+        with _limits_guard:
+            _limits.discard(limit)
@@ -1,9 +1,19 @@
 import errno
 import os
+import shutil
 
 import click
 import platformdirs
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctl that shares the data blocks of two files on copy-on-write filesystems
+FICLONE = 0x40049409
+_reflink_supported = fcntl is not None
+
 
 _platformdirs = platformdirs.PlatformDirs('art')
 artifacts_file = 'artifacts.yml'
@@ -56,3 +66,119 @@ def lockfile(path):
         return path[:-5]+'.lock.yaml'
 
     return path+'.lock'
+
+def _clone(source_fd, target_fd):
+    """Make an empty file share the data blocks of another, where supported"""
+    global _reflink_supported
+
+    if not _reflink_supported:
+        return False
+
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return True
+    except OSError as exc:
+        # remember when the filesystem (or OS) has no reflink support at all
+        if exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            _reflink_supported = False
+
+    return False
+
+def _reflink(source, target):
+    if not _reflink_supported:
+        return False
+
+    with open(source, 'rb') as fsource, open(target, 'wb') as ftarget:
+        if _clone(fsource.fileno(), ftarget.fileno()):
+            return True
+
+    os.remove(target)
+    return False
+
+def reflink_file(source, target):
+    """
+    Create target as a copy-on-write clone (reflink) of source
+
+    Returns False, without creating target, where the filesystem doesn't
+    support it.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+
+    return _reflink(source, target)
+
+def clone_file(source, target):
+    """
+    Create target with the content of source without copying its data
+
+    The target is a copy-on-write clone (reflink) where the filesystem supports
+    it, or else a hard link to source. The data is copied as a last resort.
+    """
+    if reflink_file(source, target):
+        return
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+COPY_BUFSIZE = 1024 * 1024
+
+def _copy_file_range(source_fd, target_fd, offset, count):
+    return os.copy_file_range(source_fd, target_fd, count, offset)
+
+def _sendfile(source_fd, target_fd, offset, count):
+    return os.sendfile(target_fd, source_fd, offset, count)
+
+def _pread_write(source_fd, target_fd, offset, count):
+    return os.write(target_fd, os.pread(source_fd, min(count, COPY_BUFSIZE), offset))
+
+def _seek_read_write(source_fd, target_fd, offset, count):
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    return os.write(target_fd, os.read(source_fd, min(count, COPY_BUFSIZE)))
+
+def copy_range(fsource, ftarget, offset, count):
+    """
+    Copy `count` bytes at `offset` of the fsource file to the end of ftarget
+
+    A copy of a whole file is a reflink where the filesystem supports it.
+    Otherwise the kernel copies the data with copy_file_range or sendfile,
+    and the data only passes through user space when both are unavailable.
+    The position of fsource is left unchanged, so threads can share it,
+    except on systems without os.pread, like Windows.
+    """
+    source_fd, target_fd = fsource.fileno(), ftarget.fileno()
+    ftarget.flush()
+
+    if offset == 0 and count == os.fstat(source_fd).st_size and ftarget.tell() == 0:
+        if _clone(source_fd, target_fd):
+            os.lseek(target_fd, count, os.SEEK_SET)
+            return
+
+    copies = [copy for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+              if hasattr(os, name)]
+    copies.append(_pread_write if hasattr(os, 'pread') else _seek_read_write)
+
+    end = offset + count
+    while offset < end:
+        try:
+            copied = copies[0](source_fd, target_fd, offset, end - offset)
+        except OSError:
+            # e.g. files on different filesystems, or a target that isn't a socket
+            if len(copies) == 1:
+                raise
+            copies.pop(0)
+            continue
+
+        if copied == 0:
+            if len(copies) == 1:
+                raise OSError('Unexpected end of file after {} bytes'.format(offset))
+            copies.pop(0)
+            continue
+
+        offset += copied
+
+def statefile(path):
+    """Get the install state file path from an artifacts.lock.yml path"""
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.{}.state'.format(basename))
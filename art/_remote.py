@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import io
+import re
+
+
+class RangesNotSupported(Exception):
+    """Raised when a server answers a range request with the whole file"""
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    A read-only, seekable file fetched piecewise with HTTP range requests
+
+    The end of the file is fetched up front, since that's where readers of
+    ZIP archives start. Other reads fetch at least READ_AHEAD bytes, and
+    every fetched range is kept in memory.
+    """
+
+    # large enough for the ZIP end of central directory record and its comment
+    TAIL_SIZE = 128 * 1024
+    READ_AHEAD = 64 * 1024
+
+    def __init__(self, request, url):
+        """
+        Parameters:
+        request  Function sending a GET request for a url and headers dict,
+                 returning a streamed requests.Response
+        url      The URL of the file
+        """
+        super().__init__()
+        self._request = request
+        self._url = url
+        self._pos = 0
+        self._segments = []
+        self.requests = 0
+
+        start, data, self.size = self._fetch('bytes=-%d' % self.TAIL_SIZE)
+        self._segments.append((start, data))
+
+    def _fetch(self, byte_range):
+        self.requests += 1
+        response = self._request(self._url, {'Range': byte_range})
+        try:
+            content_range = response.headers.get('Content-Range', '')
+            match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', content_range.strip())
+            if response.status_code != 206 or not match:
+                raise RangesNotSupported(self._url)
+
+            return int(match.group(1)), response.content, int(match.group(3))
+        finally:
+            response.close()
+
+    def _read_at(self, pos, size):
+        for start, data in self._segments:
+            if start <= pos and pos + size <= start + len(data):
+                return data[pos - start:pos - start + size]
+
+        end = min(pos + max(size, self.READ_AHEAD), self.size) - 1
+        start, data, _ = self._fetch('bytes=%d-%d' % (pos, end))
+        self._segments.append((start, data))
+        return data[pos - start:pos - start + size]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % (whence,))
+
+        if self._pos < 0:
+            raise OSError('negative seek position %d' % self._pos)
+        return self._pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), max(self.size - self._pos, 0))
+        if size == 0:
+            return 0
+
+        data = self._read_at(self._pos, size)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size - self._pos, 0)
+
+        buffer = bytearray(size)
+        count = self.readinto(buffer)
+        return bytes(buffer[:count])
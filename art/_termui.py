@@ -2,18 +2,25 @@
 
 from __future__ import absolute_import
 
+import threading
+
 import click
 
 silent = False
 
+# keep lines written by worker threads from interleaving
+_lock = threading.Lock()
+
 def echo(*args, **kwargs):
     global silent
 
     if not silent:
-        click.echo(*args, **kwargs)
+        with _lock:
+            click.echo(*args, **kwargs)
 
 def secho(*args, **kwargs):
     global silent
 
     if not silent:
-        click.secho(*args, **kwargs)
+        with _lock:
+            click.secho(*args, **kwargs)
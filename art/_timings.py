@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+
+import threading
+import time
+
+from . import _termui
+
+# Set by the --timings option
+enabled = False
+
+_lock = threading.Lock()
+_start = time.perf_counter()
+
+# (start, stop) intervals of each phase, overall and per entry
+_phases = {}
+_entries = {}
+_entry_phases = {}
+
+COUNTERS = ('api_requests', 'retries', 'bytes_downloaded', 'bytes_written')
+_counters = dict.fromkeys(COUNTERS, 0)
+
+# whether each cached file was found in the cache when first needed
+_cache_lookups = {}
+
+
+def start():
+    """Start measuring, from the beginning of the command"""
+    global enabled, _start
+
+    enabled = True
+    _start = time.perf_counter()
+
+
+@contextmanager
+def phase(name, entry=None):
+    """Measure the time spent in a phase of the command, optionally for an artifacts.yml entry"""
+    if not enabled:
+        yield
+        return
+
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        interval = (begin, time.perf_counter())
+        with _lock:
+            _phases.setdefault(name, []).append(interval)
+            if entry is not None:
+                _entries.setdefault(id(entry), entry)
+                _entry_phases.setdefault(id(entry), {}).setdefault(name, []).append(interval)
+
+
+def count(name, amount=1):
+    """Add to one of the COUNTERS"""
+    if enabled:
+        with _lock:
+            _counters[name] += amount
+
+
+def cache_lookup(filename, hit):
+    """Record whether a file was found in the cache. Only the first lookup of a file counts."""
+    if enabled:
+        with _lock:
+            _cache_lookups.setdefault(filename, hit)
+
+
+def _wall_time(intervals):
+    """Get the time covered by a list of possibly overlapping intervals"""
+    total = 0.0
+    end = None
+    for begin, stop in sorted(intervals):
+        if end is None or begin > end:
+            total += stop - begin
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+
+    return total
+
+
+def _rate(size, seconds):
+    return round(size / seconds / 1e6, 1) if seconds else None
+
+
+def report():
+    """
+    Get the measurements as a JSON-serializable dict
+
+    Phases report their wall time, so work done by several threads at once
+    is counted once.
+    """
+    with _lock:
+        phases = { name: _wall_time(intervals) for name, intervals in _phases.items() }
+        entries = []
+        for key, entry in _entries.items():
+            label = { field: entry[field] for field in ('project', 'ref', 'job', 'package', 'filename') if field in entry }
+            label['seconds'] = { name: round(_wall_time(intervals), 3) for name, intervals in _entry_phases[key].items() }
+            entries.append(label)
+        counters = _counters.copy()
+        hits = sum(_cache_lookups.values())
+        misses = len(_cache_lookups) - hits
+
+    result = {
+        'seconds': round(time.perf_counter() - _start, 3),
+        'phases': { name: round(seconds, 3) for name, seconds in phases.items() },
+        'entries': entries,
+        'download_mb_per_s': _rate(counters['bytes_downloaded'], phases.get('download')),
+        'write_mb_per_s': _rate(counters['bytes_written'], phases.get('extract')),
+    }
+    result.update(counters)
+    result.update({ 'cache_hits': hits, 'cache_misses': misses })
+    return result
+
+
+def echo_report():
+    """Print the measurements to standard error"""
+    timings = report()
+
+    _termui.echo('Timings: %.2fs total' % timings['seconds'], err=True)
+    for name, seconds in timings['phases'].items():
+        _termui.echo('  %-10s %8.2fs' % (name, seconds), err=True)
+    for entry in timings['entries']:
+        label = ' '.join(str(value) for field, value in entry.items() if field != 'seconds')
+        phases = ', '.join('%s %.2fs' % item for item in entry['seconds'].items())
+        _termui.echo('  %s: %s' % (label, phases), err=True)
+
+    rate = lambda value: '-' if value is None else value
+    _termui.echo('  downloaded %d bytes (%s MB/s), wrote %d bytes (%s MB/s)' % (
+        timings['bytes_downloaded'], rate(timings['download_mb_per_s']),
+        timings['bytes_written'], rate(timings['write_mb_per_s'])), err=True)
+    _termui.echo('  %d API requests, %d retried, %d cache hits, %d cache misses' % (
+        timings['api_requests'], timings['retries'], timings['cache_hits'], timings['cache_misses']), err=True)
@@ -3,11 +3,17 @@
 import click
 import yaml
 
+from . import _timings
+
+# libyaml parses and emits large lock files much faster, when PyYAML was built with it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 def load(path):
     try:
-        with open(path, 'r') as stream:
-            return yaml.safe_load(stream=stream)
+        with open(path, 'r') as stream, _timings.phase('yaml'):
+            return yaml.load(stream, Loader=SafeLoader)
     except FileNotFoundError:
         return None
     except OSError as exc:
@@ -15,7 +21,7 @@ def load(path):
 
 def save(path, obj):
     try:
-        with open(path, 'w') as stream:
-            yaml.safe_dump(obj, stream=stream, default_flow_style=False)
+        with open(path, 'w') as stream, _timings.phase('yaml'):
+            yaml.dump(obj, stream=stream, Dumper=SafeDumper, default_flow_style=False)
     except OSError as exc:
         raise click.ClickException('Failed to write file: %s' % exc)
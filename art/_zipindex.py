@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import array
+import os
+import struct
+import sys
+import threading
+import zipfile
+
+from . import _paths
+
+# ZIP local file header: signature, 22 bytes of fields, file name length, extra field length
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+# magic, archive size, archive modification time, number of members, size of the names
+HEADER = struct.Struct('<8sQqQQ')
+MAGIC = b'ARTZIX\x00\x01'
+
+# Member fields stored in one array each, with their array type
+FIELDS = (
+    ('header_offset', 'Q'),
+    ('compress_size', 'Q'),
+    ('file_size', 'Q'),
+    ('CRC', 'I'),
+    ('external_attr', 'I'),
+    ('compress_type', 'H'),
+    ('flag_bits', 'H'),
+    ('create_system', 'B'),
+)
+
+# Flag bits of encrypted or patched members, which are left to zipfile
+_ZIPFILE_ONLY_FLAGS = 0x1 | 0x20 | 0x40
+
+
+class ZipMember():
+    """The fields of an archive member that art uses, like a zipfile.ZipInfo"""
+
+    __slots__ = ('filename',) + tuple(name for name, _ in FIELDS)
+
+    def __init__(self, filename, values):
+        self.filename = filename
+        for (name, _), value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    def is_dir(self):
+        return self.filename.endswith('/')
+
+
+class _FileView():
+    """
+    A read-only stream on an open file with a position of its own
+
+    Reads don't move the position of the file, so threads can read it
+    through their own view.
+    """
+
+    def __init__(self, fd, position):
+        self._fd = fd
+        self._position = position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(os.fstat(self._fd).st_size - self._position, 0)
+        data = os.pread(self._fd, size, self._position)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self._fd).st_size
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class ZipIndex():
+    """
+    The central directory of a ZIP file, kept in arrays
+
+    It answers the namelist(), getinfo() and open() calls of art like a
+    zipfile.ZipFile, without creating a ZipInfo object for every member.
+    Members are read through the open ZIP file with os.pread, so threads can
+    share an index, and the file can't be replaced or removed under it.
+    """
+
+    def __init__(self, fileobj, names, arrays):
+        self._fileobj = fileobj
+        self._names = names
+        self._arrays = arrays
+        self._positions = None
+        self._zipfile = None
+        self._lock = threading.Lock()
+
+    def namelist(self):
+        return list(self._names)
+
+    def getinfo(self, name):
+        """Get the member with the given name, the last one if there are several"""
+        with self._lock:
+            if self._positions is None:
+                self._positions = { member: index for index, member in enumerate(self._names) }
+        index = self._positions[name]
+        return ZipMember(name, (values[index] for values in self._arrays))
+
+    def open(self, member):
+        """Open a member for reading its decompressed content"""
+        # zipfile shares the file between its members with a lock of its own
+        if member.flag_bits & _ZIPFILE_ONLY_FLAGS or not hasattr(os, 'pread'):
+            with self._lock:
+                if self._zipfile is None:
+                    self._zipfile = zipfile.ZipFile(self._fileobj)
+            return self._zipfile.open(member.filename)
+
+        # the extra field of the local header may differ from the central directory
+        stream = _FileView(self._fileobj.fileno(), member.header_offset)
+        header = stream.read(ZIP_LOCAL_HEADER.size)
+        if len(header) != ZIP_LOCAL_HEADER.size:
+            raise zipfile.BadZipFile('Truncated file header')
+        signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(header)
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile('Bad magic number for file header')
+        stream.seek(name_length + extra_length, os.SEEK_CUR)
+
+        return zipfile.ZipExtFile(stream, 'r', member)
+
+    def close(self):
+        if self._zipfile is not None:
+            self._zipfile.close()
+
+
+def _encode_names(names):
+    return '\0'.join(names).encode('utf-8', 'surrogateescape')
+
+def _decode_names(data, count):
+    return data.decode('utf-8', 'surrogateescape').split('\0') if count else []
+
+def build(fileobj, index_path):
+    """Parse the central directory of an open ZIP file, and save its index"""
+    st = os.fstat(fileobj.fileno())
+    with zipfile.ZipFile(fileobj) as archive:
+        members = archive.infolist()
+
+    names = [member.filename for member in members]
+    arrays = [array.array(typecode, (getattr(member, name) for member in members)) for name, typecode in FIELDS]
+    data = _encode_names(names)
+
+    _paths.mkdirs(os.path.dirname(index_path))
+    index_tmp = '{}.{}.{}.tmp'.format(index_path, os.getpid(), threading.get_ident())
+    with open(index_tmp, 'wb') as stream:
+        stream.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, len(names), len(data)))
+        stream.write(data)
+        for values in arrays:
+            if sys.byteorder != 'little':
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            values.tofile(stream)
+    os.replace(index_tmp, index_path)
+
+    return ZipIndex(fileobj, names, arrays)
+
+def _read(fileobj, index_path):
+    """Read a saved index, or get None if it's missing or doesn't match the ZIP file anymore"""
+    st = os.fstat(fileobj.fileno())
+    try:
+        with open(index_path, 'rb') as stream:
+            data = stream.read()
+    except OSError:
+        return None
+
+    if len(data) < HEADER.size:
+        return None
+    magic, size, mtime, count, names_size = HEADER.unpack_from(data)
+    if magic != MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+        return None
+
+    arrays = [array.array(typecode) for _, typecode in FIELDS]
+    if len(data) != HEADER.size + names_size + count * sum(values.itemsize for values in arrays):
+        return None
+
+    offset = HEADER.size + names_size
+    names = _decode_names(data[HEADER.size:offset], count)
+    for values in arrays:
+        end = offset + count * values.itemsize
+        values.frombytes(data[offset:end])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        offset = end
+
+    if len(names) != count:
+        return None
+    return ZipIndex(fileobj, names, arrays)
+
+def load(fileobj, index_path):
+    """
+    Get the index of an open ZIP file
+
+    The index saved at index_path is used as long as the size and modification
+    time of the ZIP file match. Otherwise it's built and saved again.
+    """
+    return _read(fileobj, index_path) or build(fileobj, index_path)
@@ -4,10 +4,13 @@ from __future__ import absolute_import
 
 import contextlib
 import fnmatch
+import hashlib
 import math
 import os
 import stat
 import sys
+import threading
+import time
 import zipfile
 import json
 
@@ -16,9 +19,13 @@ from . import _cache
 from . import _config
 from . import _gitlab
 from . import _install
+from . import _parallel
 from . import _paths
+from . import _remote
 from . import _termui
+from . import _timings
 from . import _yaml
+from . import _zipindex
 from . import __version__ as version
 
 def is_using_job_token(gitlab):
@@ -36,16 +43,69 @@ def is_using_job_token(gitlab):
     return gitlab.job_token is not None
 
 
+class RefJobs():
+    """The last successful job of each name in the pipelines of a project ref
+
+    Pipelines are scanned newest first, one page of 100 at a time, and only
+    as far as needed to find the requested job. The scan is shared by all
+    entries that request jobs from the same project and ref.
+    """
+
+    PAGE_SIZE = 100
+
+    _scans = {}
+    _scans_guard = threading.Lock()
+
+    @classmethod
+    def get(cls, project, ref):
+        """Get the shared scan for a project ref"""
+        with cls._scans_guard:
+            key = (project.id, ref)
+            if key not in cls._scans:
+                cls._scans[key] = cls(project, ref)
+            return cls._scans[key]
+
+    def __init__(self, project, ref):
+        # the pipelines are listed on the first find(), the listing sends a request
+        self._project = project
+        self._ref = ref
+        self._pipelines = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _scan_pipeline(self, pipeline):
+        seen = set()
+        jobs = pipeline.jobs.list(scope='success', per_page=self.PAGE_SIZE, iterator=True)
+        for job in jobs:
+            # only the first successful job of each name counts for a pipeline
+            if job.name in seen:
+                continue
+            seen.add(job.name)
+
+            if job.name in self._jobs:
+                continue
+            artifact = next((artifact for artifact in job.artifacts if artifact['file_type'] == 'archive'), None)
+            if artifact:
+                self._jobs[job.name] = (job.id, artifact['filename'], pipeline.sha)
+
+    def find(self, job_name):
+        """Get the (job_id, filename, commit) of the last successful job, or None"""
+        with self._lock:
+            if self._pipelines is None:
+                self._pipelines = self._project.pipelines.list(ref=self._ref, order_by='id', sort='desc',
+                                                               per_page=self.PAGE_SIZE, iterator=True)
+            while job_name not in self._jobs:
+                pipeline = next(self._pipelines, None)
+                if pipeline is None:
+                    return None
+                self._scan_pipeline(pipeline)
+
+            return self._jobs[job_name]
+
 def get_ref_last_successful_job(project, ref, job_name):
-    pipelines = project.pipelines.list(ref=ref, order_by='id', sort='desc', iterator=True)
-    for pipeline in pipelines:
-        jobs = pipeline.jobs.list(scope='success', iterator=True)
-        try:
-            job = next(job for job in jobs if job.name == job_name)
-            artifact = next(artifact for artifact in job.artifacts if artifact['file_type'] == 'archive')
-            return job.id, artifact['filename'], pipeline.sha
-        except StopIteration:
-            continue
+    job = RefJobs.get(project, ref).find(job_name)
+    if job:
+        return job
 
     raise click.ClickException("Could not find latest successful '{}' job for {} ref {}".format(
             job_name, project.path_with_namespace, ref))
@@ -65,8 +125,27 @@ def artifact_name(entry):
 
     return os.path.join(entry['project'], '{}{}'.format(filename, fileext))
 
-def zip_archive(entry, fileobj):
+def entry_fingerprint(entry, keep_empty_dirs):
+    """Get a digest of an artifacts.yml entry and of the options that change its lock entry"""
+    spec = json.dumps([entry, keep_empty_dirs], sort_keys=True, default=str)
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+def is_immutable(entry):
+    """Determine if an entry always resolves to the same artifact: a commit id, or a package version"""
+    if entry.get('source', 'ci-job') == 'generic-package':
+        return True
+    return _gitlab.is_commit_id(str(entry.get('ref', '')))
+
+def zip_archive(entry, fileobj, index=False):
+    """
+    Open the ZIP archive of an entry
+
+    With index, fileobj is the cached artifact, which is read through the
+    member index kept in the cache instead of its central directory.
+    """
     try:
+        if index:
+            return _zipindex.load(fileobj, _cache.zip_index_path(artifact_name(entry)))
         return zipfile.ZipFile(fileobj)
     except zipfile.BadZipFile as exc:
         archive_path = _cache.cache_path(artifact_name(entry))
@@ -85,8 +164,33 @@ def canonical_request_path(entry, path):
 
     return path
 
-def get_files_for_entry(gitlab, entry, keep_empty_dirs):
-    """Build the list of archive files that match the install requests for an entry"""
+# Member names of the archives listed during this run, by artifact name
+_listings = {}
+_listings_guard = threading.Lock()
+
+def list_archive(gitlab, entry, range_requests):
+    """
+    Get the member names of the archive of an entry
+
+    The archive is opened and its central directory parsed once per run, for
+    all the entries that share it.
+    """
+    name = artifact_name(entry)
+    with _listings_guard:
+        listing = _listings.setdefault(name, {'lock': threading.Lock()})
+
+    with listing['lock']:
+        if 'members' not in listing:
+            with open_listing_source(gitlab, entry, range_requests) as archive:
+                listing['members'] = archive.namelist()
+        return listing['members']
+
+def get_files_for_entry(gitlab, entry, keep_empty_dirs, range_requests=False):
+    """Build the list of archive files that match the install requests for an entry
+
+    With range_requests, an archive that isn't cached yet is listed by fetching
+    only its central directory from the server.
+    """
     files = []
 
     # Explanation of relevant keys for each entry:
@@ -117,11 +221,12 @@ def get_files_for_entry(gitlab, entry, keep_empty_dirs):
 
         return files
 
-    # open the artifact file for extraction
-    with open_install_source(gitlab, entry) as (artifact_file, archive):
+    index = _install.InstallActionIndex(actions)
+
+    with _timings.phase('scan', entry):
         # iterate over the zip archive
-        for member in archive.infolist():
-            filepath = member.filename
+        for member_name in list_archive(gitlab, entry, range_requests):
+            filepath = member_name
 
             # Skip directory members
             # - Parent directories are created when installing files
@@ -133,11 +238,8 @@ def get_files_for_entry(gitlab, entry, keep_empty_dirs):
             filepath = canonical_request_path(entry, filepath)
 
             # Check if this file matches an install request
-            for action in actions:
-                if not action.match(filepath):
-                    continue
-
-                files.append({ member.filename: action.translate(filepath) })
+            for action in index.match(filepath):
+                files.append({ member_name: action.translate(filepath) })
 
                 # Remove the install request from the list now that it's been fulfilled
                 install_requests.pop(action.src, None)
@@ -148,6 +250,22 @@ def get_files_for_entry(gitlab, entry, keep_empty_dirs):
 
     return files
 
+def get_entry_files(entry):
+    """
+    Get the (archive path, target) pairs recorded in a lock entry, from either
+    its `files` list or the compact `file_prefixes` records
+
+    Returns None if the lock entry doesn't list its files.
+    """
+    if 'file_prefixes' in entry:
+        return _install.expand_file_prefixes(entry['file_prefixes'])
+
+    files = entry.get('files', None)
+    if not files:
+        return None
+
+    return (next(iter(file_spec.items())) for file_spec in files)
+
 def get_short_id(entry):
     source = entry.get('source', 'ci-job')
     if source == 'repository':
@@ -157,6 +275,19 @@ def get_short_id(entry):
 
     return entry['job_id']
 
+def get_resolved_id(entry):
+    """Get the job id, commit or package file id that the ref of an entry resolved to"""
+    source = entry.get('source', 'ci-job')
+    if source == 'repository':
+        return entry.get('commit', None)
+    elif source == 'generic-package':
+        return entry.get('package_file_id', None)
+
+    return entry.get('job_id', None)
+
+# Number of times an interrupted download is resumed before giving up
+DOWNLOAD_ATTEMPTS = 5
+
 def download_artifact(gitlab, entry, filename):
     """Download the artifact file for an artifacts.yml entry to the cache"""
     source = entry.get('source', 'ci-job')
@@ -174,70 +305,372 @@ def download_artifact(gitlab, entry, filename):
     fail_msg = 'Failed to download %s from "%s"' % (
         entry_id_str,
         entry['project'])
-    with _gitlab.wrap_errors(gitlab, fail_msg):
-        # Use shallow objects for proj and job to allow compatibility with
-        # job tokens where only the artifacts endpoint is accessible.
-        proj = gitlab.projects.get(entry['project'], lazy=True)
-
-        with _cache.save_file(filename) as fileobj:
-            if source == 'ci-job':
-                job = proj.jobs.get(entry['job_id'], lazy=True)
-                job.artifacts(streamed=True, action=fileobj.write)
-            elif source == 'repository':
-                proj.repository_archive(streamed=True, action=fileobj.write, sha=entry['commit'], format='zip')
-            elif source == 'generic-package':
-                # Download the generic package file
-                proj.generic_packages.download(streamed=True, action=fileobj.write,
-                    package_name=entry['package'],
-                    package_version=entry['ref'],
-                    file_name=entry['filename']
-                )
+
+    # Job artifacts and package files never change, so a partial file is
+    # resumed and checked against the size of the whole file, and against the
+    # checksum when the lock file has one. Archives of a repository are
+    # generated on request and may differ between requests.
+    sha256 = entry.get('sha256', None)
+    resume = source != 'repository'
+
+    # A resumed download that doesn't match the checksum is downloaded again once
+    for restart in (False, True):
+        with _gitlab.wrap_errors(gitlab, fail_msg), _timings.phase('download', entry):
+            # Download straight from the artifact endpoints to allow compatibility
+            # with job tokens where only these endpoints are accessible.
+            url = _gitlab.artifact_url(gitlab, entry)
+
+            # A partial file left by an interrupted download is resumed
+            with _cache.save_file(filename, source, resume=resume) as fileobj:
+                for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                    try:
+                        resumed = _gitlab.download(gitlab, url, fileobj, resume)
+                        break
+                    except _gitlab.TRANSFER_ERRORS as exc:
+                        if attempt == DOWNLOAD_ATTEMPTS:
+                            raise
+                        _gitlab.count_retry('%s: %s => interrupted after %d bytes (%s)' % (
+                            entry['project'], entry_short_id, fileobj.size, type(exc).__name__))
+                        time.sleep(_gitlab.backoff_time(attempt))
+
+        if not sha256 or _cache.digest(filename) == sha256:
+            break
+
+        _cache.remove(filename)
+        if restart or not resumed:
+            raise click.ClickException('Downloaded %s from "%s" does not match the checksum in %s' % (
+                entry_id_str, entry['project'], _paths.artifacts_lock_file))
+        _termui.echo('* %s: %s => resumed download does not match the checksum, downloading again...' % (
+            entry['project'], entry_short_id))
+
+    # Index the members of the archive while its central directory is in the page cache
+    if entry.get('extract', True):
+        try:
+            with open(_cache.cache_path(filename), 'rb') as stream:
+                _zipindex.build(stream, _cache.zip_index_path(filename))
+        except zipfile.BadZipFile:
+            # reported when the archive is extracted
+            pass
 
     _termui.echo('* %s: %s => downloaded.' % (entry['project'], entry_short_id))
 
+def verify_cached_artifact(entry, filename):
+    """
+    Check a cached artifact against the checksum recorded in the lock file
 
+    A damaged artifact is removed from the cache so that it's downloaded again.
+    """
+    sha256 = entry.get('sha256', None)
+    if not sha256:
+        return
+
+    with _timings.phase('verify', entry):
+        digest = _cache.digest(filename)
+    if digest is not None and digest != sha256:
+        _termui.echo('* %s: %s => checksum mismatch, removed from cache' % (entry['project'], get_short_id(entry)))
+        _cache.remove(filename)
+
+
+def lock_artifact(entry, filename):
+    """Lock a cached artifact, telling when another process holds it, e.g. to download it"""
+    waiting = lambda: _termui.echo('* %s: %s => waiting for another process...' % (entry['project'], get_short_id(entry)))
+    return _cache.lock(filename, waiting)
+
+
+def fetch_artifact(gitlab, entry):
+    """Download the artifact file for an entry unless it is already cached
+
+    Returns True if the artifact was downloaded.
+    """
+    filename = artifact_name(entry)
+    with lock_artifact(entry, filename):
+        verify_cached_artifact(entry, filename)
+        if _cache.contains(filename):
+            _timings.cache_lookup(filename, True)
+            return False
+
+        _timings.cache_lookup(filename, False)
+        download_artifact(gitlab, entry, filename)
+        return True
+
+@contextlib.contextmanager
 def open_cached_artifact(gitlab, entry):
-    """Open the archive file for an entry. Download if necessary"""
+    """
+    Open the archive file for an entry. Download if necessary
 
+    The artifact stays locked while it's open, so that other processes don't
+    evict it, or its extracted members, while it's used.
+    """
     filename = artifact_name(entry)
-    try:
-        return _cache.get(filename)
-    except KeyError:
-        pass
+    with lock_artifact(entry, filename):
+        verify_cached_artifact(entry, filename)
+        try:
+            stream = _cache.get(filename)
+            _timings.cache_lookup(filename, True)
+        except KeyError:
+            _timings.cache_lookup(filename, False)
+            download_artifact(gitlab, entry, filename)
+            try:
+                stream = _cache.get(filename)
+            except KeyError as exc:
+                msg = 'File "%s" was not found after download' % _cache.cache_path(filename)
+                raise click.ClickException(msg) from exc
+
+        with stream:
+            yield stream
 
-    download_artifact(gitlab, entry, filename)
+@contextlib.contextmanager
+def open_remote_archive(gitlab, entry):
+    """Open the archive of an entry on the server, reading it with range requests"""
+    url = _gitlab.artifact_url(gitlab, entry)
+    request = lambda url, headers: _gitlab.request(gitlab, url, headers)
+    fail_msg = 'Failed to read archive of "%s" %s' % (entry['project'], get_short_id(entry))
+    with _gitlab.wrap_errors(gitlab, fail_msg), _timings.phase('scan', entry):
+        archive = zip_archive(entry, _remote.RemoteFile(request, url))
 
     try:
-        return _cache.get(filename)
-    except KeyError as exc:
-        msg = 'File "%s" was not found after download' % _cache.cache_path(filename)
-        raise click.ClickException(msg) from exc
+        yield archive
+    finally:
+        archive.close()
+
+@contextlib.contextmanager
+def open_listing_source(gitlab, entry, range_requests):
+    """
+    Open the archive of an entry to list its members
+
+    With range_requests, an archive that isn't cached is read from the server
+    with HTTP range requests. The archive is downloaded if the server doesn't
+    support them.
+    """
+    archive = None
+    with contextlib.ExitStack() as stack:
+        if range_requests and not _cache.contains(artifact_name(entry)):
+            try:
+                archive = stack.enter_context(open_remote_archive(gitlab, entry))
+            except _remote.RangesNotSupported:
+                pass
+
+        if archive is None:
+            _, archive = stack.enter_context(open_install_source(gitlab, entry))
+
+        yield archive
 
 @contextlib.contextmanager
 def open_install_source(gitlab, entry):
     archive = None
-    archive_file = None
     extract = entry.get('extract', True)
-    try:
-        archive_file =  open_cached_artifact(gitlab, entry)
-        if extract:
-            archive = zip_archive(entry, archive_file)
+    with open_cached_artifact(gitlab, entry) as archive_file:
+        try:
+            if extract:
+                archive = zip_archive(entry, archive_file, index=True)
 
-        yield archive_file, archive
-    finally:
-        if archive:
-            archive.close()
-        if archive_file:
-            archive_file.close()
+            yield archive_file, archive
+        finally:
+            if archive:
+                archive.close()
+
+def extract_files(artifact_file, archive, files, link_tree, jobs):
+    """
+    Install archive members using `jobs` threads
+
+    Each member is read once: when it's installed to several targets, the
+    later targets are copies of the first one. Each target appears once in
+    files, the install command drops the files overwritten by a later one.
+    Returns the (target, filemode) pair of each file, in order.
+    """
+    if not archive:
+        return [_install.install(artifact_file, archive, filepath, target, link_tree) for filepath, target in files]
+
+    written = {}
+    reads = []
+    copies = []
+    for index, (filepath, target) in enumerate(files):
+        if filepath in written:
+            copies.append(index)
+        else:
+            reads.append(index)
+            if not target.endswith('/'):
+                written[filepath] = target
+
+    # the archive index reads each member through its own file handle
+    def extract_one(index):
+        filepath, target = files[index]
+        return _install.install(artifact_file, archive, filepath, target, link_tree)
+
+    def copy_one(index):
+        filepath, target = files[index]
+        return _install.install(artifact_file, archive, filepath, target, link_tree, written[filepath])
+
+    results = [None] * len(files)
+
+    # copies are made once all the files they are copied from were written
+    for func, indices in ((extract_one, reads), (copy_one, copies)):
+        if jobs > 1:
+            outcomes = _parallel.run(func, indices, jobs)
+        else:
+            outcomes = [(func(index), None) for index in indices]
+
+        for index, (result, exc) in zip(indices, outcomes):
+            if exc:
+                raise exc
+            results[index] = result
+
+    return results
+
+def install_files(gitlab, entry, files, link, jobs):
+    """
+    Install the (archive path, target) pairs of files for a lock entry
+
+    Returns the install state records of the installed targets.
+    """
+    name = artifact_name(entry)
+    link_tree = name if link else None
+    installed = {}
+    with open_install_source(gitlab, entry) as (artifact_file, archive):
+        with _timings.phase('extract', entry):
+            results = extract_files(artifact_file, archive, files, link_tree, jobs)
+
+        permissions = {}
+        for (filepath, _), (target, filemode) in zip(files, results):
+            # File permissions are applied in a second pass. This prevents restrictive
+            # permissions from preventing extraction (e.g. a non-empty, read-only directory)
+            # without requiring depth-first traversal
+            crc = archive.getinfo(filepath).CRC if archive else None
+            permissions[target] = (filemode, [name, filepath], crc)
+
+            filemode_str = '   ' + stat.filemode(filemode)
+            request_path = canonical_request_path(entry, filepath)
+            _termui.echo('* install: %s => %s%s' % (request_path, target, filemode_str))
+
+        for target, (filemode, source, crc) in permissions.items():
+            os.chmod(target, filemode)
+            installed[target] = _install.state_record(source, target, filemode, crc)
+
+    return installed
+
+def resolve_entry(gitlab, entry):
+    """Resolve the ref of an artifacts.yml entry to a job, commit or package file"""
+    project = entry.get('project', None)
+    ref = entry.get('ref', None)
+    source = entry.get('source', 'ci-job')
+
+    if source == 'ci-job':
+        job = entry.get('job', None)
+        if not job:
+            raise click.ClickException('No job was specified for project "%s" ref "%s"' % (project, ref))
+
+        # Get the latest job ID for "ci-job" sources
+        fail_msg = 'Failed to get last successful "%s" job for "%s" ref "%s"' % (
+            job,
+            project,
+            ref)
+        with _gitlab.wrap_errors(gitlab, fail_msg):
+            proj = _gitlab.get_project(gitlab, project)
+            job_id, filename, commit = get_ref_last_successful_job(proj, ref, job)
+            entry['job_id'] = job_id
+            entry['commit'] = commit
+            entry['filename'] = filename
+    elif source == 'repository':
+        # Resolve the ref to a commit for "repository" sources
+        fail_msg = 'Failed to find ref "%s" for "%s"' % (ref, project)
+        with _gitlab.wrap_errors(gitlab, fail_msg):
+            proj = _gitlab.get_project(gitlab, project)
+            entry['commit'] = _gitlab.get_commit(proj, ref)
+            entry['filename'] = "{}-{}.zip".format(proj.path, ref)
+    elif source == 'generic-package':
+        # Resolve the package_file_id for "generic-package" sources
+        package = entry.get('package', None)
+        if not package:
+            raise click.ClickException('No package was specified for project "%s" ref "%s"' % (project, ref))
+
+        filename = entry.get('filename', None)
+        if not filename:
+            raise click.ClickException('No filename was specified for package "%s" project "%s" ref "%s"' % (package, project, ref))
+
+        package_id, package_file_id, sha256 = _gitlab.get_package_file(gitlab, project, package, ref, filename)
+        entry['package_id'] = package_id
+        entry['package_file_id'] = package_file_id
+        if sha256:
+            entry['sha256'] = sha256
+    else:
+        raise click.ClickException('Unknown artifact source: "%s"' % (source,))
+
+def update_entry(gitlab, entry, keep_empty_dirs, range_requests):
+    """Resolve the ref of an artifacts.yml entry and find the files to install"""
+    project = entry.get('project', None)
+    ref = entry.get('ref', None)
+    source = entry.get('source', 'ci-job')
+
+    with _timings.phase('resolve', entry):
+        resolve_entry(gitlab, entry)
+
+    # Process the artifact and find files that match the install requests
+    entry['files'] = get_files_for_entry(gitlab, entry, keep_empty_dirs, range_requests)
+
+    # Record the checksum of the artifact, unless the package registry reported it, so
+    # that the lock file doesn't depend on what's cached. Artifacts that weren't needed
+    # to list the files, like those that aren't extracted, are downloaded for it, except
+    # with range requests, which are meant to avoid downloads. Repository archives are
+    # generated on demand and may differ between downloads.
+    if source != 'repository' and 'sha256' not in entry and not range_requests:
+        with open_cached_artifact(gitlab, entry):
+            entry['sha256'] = _cache.digest(artifact_name(entry))
+
+    _termui.echo('* %s: %s => %s' % (project, ref, get_short_id(entry)))
+
+def check_entry_errors(entries, outcomes):
+    """Report the entries that failed while being processed in parallel"""
+    errors = [(entry, exc) for entry, (_, exc) in zip(entries, outcomes) if exc]
+    if not errors:
+        return
+
+    # unexpected exceptions propagate as-is
+    for _, exc in errors:
+        if not isinstance(exc, click.ClickException):
+            raise exc
+
+    if len(errors) == 1:
+        raise errors[0][1]
+
+    msg = '\n'.join('  %s: %s' % (entry.get('project'), exc.format_message()) for entry, exc in errors)
+    raise click.ClickException('%d of %d entries failed:\n%s' % (len(errors), len(entries), msg))
+
+def parse_option(parse):
+    """Create a click callback that converts an option value using parse"""
+    def callback(ctx, param, value):
+        if value is None:
+            return None
+        try:
+            return parse(value)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc)) from exc
+
+    return callback
+
+def evict_cached_artifacts(max_size, max_age, dry_run):
+    """Remove least recently used artifacts from the cache"""
+    action = "would be removed" if dry_run else "removed"
+    for project, filename in _cache.collect(max_size, max_age, dry_run):
+        _termui.echo('* %s: %s => %s.' % (project, os.path.basename(filename), action))
+
+def apply_cache_budget():
+    """Evict cached artifacts that exceed the budget set in the configuration"""
+    max_size, max_age = _config.cache_budget(_config.load())
+    if max_size is not None or max_age is not None:
+        evict_cached_artifacts(max_size, max_age, False)
 
 @click.group()
 @click.version_option(version, prog_name='art')
 @click.option('--cache', '-c', help='Download cache directory.')
 @click.option('--change-dir', '-C', metavar='DIR', type=click.Path(exists=True, file_okay=False, resolve_path=True),  help='Run as if art was started from DIR')
 @click.option('--file', '-f', metavar='FILE', type=click.Path(dir_okay=False), help='Use FILE as artifacts.yml')
-def main(cache=None, change_dir=None, file=None):
+@click.option('--timings', default=False, is_flag=True, help='Report the time spent in each phase, and the data transferred')
+def main(cache=None, change_dir=None, file=None, timings=False):
     """Art, the Gitlab artifact repository client."""
 
+    if timings:
+        _timings.start()
+
     if change_dir:
         os.chdir(change_dir)
 
@@ -254,6 +687,23 @@ def main(cache=None, change_dir=None, file=None):
     if cache is not None:
         _paths.cache_dir = cache
 
+@main.result_callback()
+def report_run(result, **kwargs):
+    if _gitlab.retries:
+        _termui.echo('* %d request(s) to GitLab were retried' % _gitlab.retries, err=True)
+
+    # with --json, the report is part of the JSON output instead
+    if _timings.enabled:
+        _timings.echo_report()
+
+def dump_json(artifacts):
+    """Print the result of a command in JSON format, with the timings report if requested"""
+    result = artifacts
+    if _timings.enabled:
+        result = { 'artifacts': artifacts, 'timings': _timings.report() }
+
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write(os.linesep)
 
 @main.command()
 @click.argument('gitlab_url')
@@ -269,7 +719,12 @@ def configure(**kwargs):
 @click.option('--keep-empty-dirs', '-k', default=False, is_flag=True, help='Do not prune empty directories.')
 @click.option('--json', '-j', 'output_json', default=False, is_flag=True, help='Output artifact information to JSON')
 @click.option('-c', '--clean', default=False, is_flag=True, help='Remove installed files before updating lock file')
-def update(keep_empty_dirs, output_json, clean):
+@click.option('--jobs', default=1, metavar='N', type=click.IntRange(min=1), help='Number of entries to resolve in parallel')
+@click.option('--range-requests', default=False, is_flag=True, help='List archives that are not cached by fetching only their central directory')
+@click.option('--compact', default=False, is_flag=True, help='Record the files to install as directory prefixes and paths under them')
+@click.option('--incremental', default=False, is_flag=True, help='Keep the lock entries of unchanged entries whose ref is a commit id or a package version')
+@click.option('--only', metavar='GLOB', help='Update only the entries of projects matching GLOB, and keep the others as locked')
+def update(keep_empty_dirs, output_json, clean, jobs, range_requests, compact, incremental, only):
     """Update latest tag/branch job IDs."""
 
     if output_json:
@@ -279,7 +734,7 @@ def update(keep_empty_dirs, output_json, clean):
         artifacts_lock = _yaml.load(_paths.artifacts_lock_file)
         remove_installed_files(artifacts_lock, False)
 
-    gitlab = _gitlab.get()
+    gitlab = _gitlab.get(pool_size=jobs)
 
     # With current GitLab (16.3, as of this writing)
     # You cannot access the projects and jobs API endpoints using a job token
@@ -290,110 +745,143 @@ def update(keep_empty_dirs, output_json, clean):
     if not artifacts:
         raise click.ClickException('The %s file was not found or did not contain any entries' % _paths.artifacts_file)
 
-    for entry in artifacts:
-        project = entry.get('project', None)
-        ref = entry.get('ref', None)
-        source = entry.get('source', 'ci-job')
-
-        if source == 'ci-job':
-            job = entry.get('job', None)
-            if not job:
-                raise click.ClickException('No job was specified for project "%s" ref "%s"' % (project, ref))
-
-            # Get the latest job ID for "ci-job" sources
-            fail_msg = 'Failed to get last successful "%s" job for "%s" ref "%s"' % (
-                job,
-                project,
-                ref)
-            with _gitlab.wrap_errors(gitlab, fail_msg):
-                proj = gitlab.projects.get(project)
-                job_id, filename, commit = get_ref_last_successful_job(proj, ref, job)
-                entry['job_id'] = job_id
-                entry['commit'] = commit
-                entry['filename'] = filename
-        elif source == 'repository':
-            # Resolve the ref to a commit for "repository" sources
-            fail_msg = 'Failed to find ref "%s" for "%s"' % (ref, project)
-            with _gitlab.wrap_errors(gitlab, fail_msg):
-                proj = gitlab.projects.get(project)
-                entry['commit'] = proj.commits.get(ref).id
-                entry['filename'] = "{}-{}.zip".format(proj.path, ref)
-        elif source == 'generic-package':
-            # Resolve the package_file_id for "generic-package" sources
-            package = entry.get('package', None)
-            if not package:
-                raise click.ClickException('No package was specified for project "%s" ref "%s"' % (project, ref))
-
-            filename = entry.get('filename', None)
-            if not filename:
-                raise click.ClickException('No filename was specified for package "%s" project "%s" ref "%s"' % (package, project, ref))
-
-            fail_msg = 'Failed to get package "%s" version "%s" for "%s"' % (package, ref, project)
-            with _gitlab.wrap_errors(gitlab, fail_msg):
-                proj = gitlab.projects.get(project)
-                packages = proj.packages.list(package_type='generic', package_name=package, package_version=ref, get_all=True)
-
-            if len(packages) != 1:
-                raise click.ClickException('More than 1 package with name "%s" version "%s" for "%s"' % (package, ref, project))
-
-            fail_msg = 'Failed to get file "%s" in package "%s" version "%s" for "%s"' % (filename, package, ref, project)
-            with _gitlab.wrap_errors(gitlab, fail_msg):
-                files = packages[0].package_files.list(get_all=True)
-                try:
-                    file = next(f for f in files if f.file_name == filename)
-                except StopIteration as exc:
-                    raise click.ClickException(fail_msg) from exc
-
-            entry['package_id']= packages[0].id
-            entry['package_file_id']= file.id
+    # lock entries that can be kept, by the fingerprint of their artifacts.yml entry
+    locked = {}
+    if incremental or only:
+        for locked_entry in _yaml.load(_paths.artifacts_lock_file) or []:
+            if 'fingerprint' in locked_entry:
+                locked.setdefault(locked_entry['fingerprint'], locked_entry)
+
+    def update_one(entry):
+        fingerprint = entry_fingerprint(entry, keep_empty_dirs)
+        selected = not only or fnmatch.fnmatch(entry.get('project', ''), only)
+        if fingerprint in locked and (not selected or (incremental and is_immutable(entry))):
+            entry.update(locked[fingerprint])
+            _termui.echo('* %s: %s => %s (kept)' % (entry['project'], entry['ref'], get_short_id(entry)))
+        elif not selected:
+            raise click.ClickException('Project "%s" ref "%s" changed since %s was updated, it must be updated as well' % (
+                entry.get('project'), entry.get('ref'), _paths.artifacts_lock_file))
         else:
-            raise click.ClickException('Unknown artifact source: "%s"' % (source,))
-
-        # Process the artifact and find files that match the install requests
-        entry['files'] = get_files_for_entry(gitlab, entry, keep_empty_dirs)
+            update_entry(gitlab, entry, keep_empty_dirs, range_requests)
+
+        files = [{ source: target } for source, target in get_entry_files(entry) or []]
+        entry.pop('file_prefixes', None)
+        entry.pop('files', None)
+        entry['fingerprint'] = fingerprint
+        if compact:
+            entry['file_prefixes'] = _install.compact_files(files)
+        else:
+            entry['files'] = files
 
-        _termui.echo('* %s: %s => %s' % (project, ref, get_short_id(entry)))
+    outcomes = _parallel.run(update_one, artifacts, jobs)
+    check_entry_errors(artifacts, outcomes)
 
     _yaml.save(_paths.artifacts_lock_file, artifacts)
 
     if output_json:
-        json.dump(artifacts, sys.stdout, indent=2)
-        sys.stdout.write(os.linesep)
+        dump_json(artifacts)
 
 
 @main.command()
-def download():
-    """Download artifacts to local cache."""
+@click.option('--json', '-j', 'output_json', default=False, is_flag=True, help='Output the state of each entry to JSON')
+@click.option('--jobs', default=4, metavar='N', type=click.IntRange(min=1), help='Number of entries to check in parallel')
+def outdated(output_json, jobs):
+    """Check whether newer jobs, commits or package files are available."""
+
+    if output_json:
+        _termui.silent = True
 
-    gitlab = _gitlab.get()
     artifacts_lock = _yaml.load(_paths.artifacts_lock_file)
     if not artifacts_lock:
         raise click.ClickException('No entries in %s file. Run "art update" first.' % _paths.artifacts_lock_file)
 
-    for entry in artifacts_lock:
-        filename = artifact_name(entry)
+    gitlab = _gitlab.get(pool_size=jobs)
+    if is_using_job_token(gitlab):
+        raise _config.ConfigException('token_type', 'A job token cannot be used to check for updates')
+
+    def check_one(locked_entry):
+        # only the ref is resolved again, archives are neither downloaded nor listed
+        entry = dict(locked_entry)
+        with _timings.phase('resolve', locked_entry):
+            resolve_entry(gitlab, entry)
+
+        is_outdated = get_resolved_id(entry) != get_resolved_id(locked_entry)
+        if is_outdated:
+            _termui.echo('* %s: %s => %s, latest is %s' % (
+                entry['project'], entry['ref'], get_short_id(locked_entry), get_short_id(entry)))
+        else:
+            _termui.echo('* %s: %s => %s (up to date)' % (entry['project'], entry['ref'], get_short_id(entry)))
 
-        if _cache.contains(filename):
+        return {
+            'project': entry['project'],
+            'ref': entry['ref'],
+            'source': entry.get('source', 'ci-job'),
+            'locked': get_resolved_id(locked_entry),
+            'latest': get_resolved_id(entry),
+            'outdated': is_outdated,
+        }
+
+    outcomes = _parallel.run(check_one, artifacts_lock, jobs)
+    check_entry_errors(artifacts_lock, outcomes)
+    results = [result for result, _ in outcomes]
+
+    if output_json:
+        dump_json(results)
+
+    count = sum(result['outdated'] for result in results)
+    if count:
+        raise click.ClickException('%d of %d entries are outdated. Run "art update" to update them.' % (count, len(results)))
+
+
+@main.command()
+@click.option('--jobs', default=1, metavar='N', type=click.IntRange(min=1), help='Number of artifacts to download in parallel')
+def download(jobs):
+    """Download artifacts to local cache."""
+
+    gitlab = _gitlab.get(pool_size=jobs)
+    artifacts_lock = _yaml.load(_paths.artifacts_lock_file)
+    if not artifacts_lock:
+        raise click.ClickException('No entries in %s file. Run "art update" first.' % _paths.artifacts_lock_file)
+
+    def download_one(entry):
+        if not fetch_artifact(gitlab, entry):
             _termui.echo('* %s: %s => present' % (entry['project'], get_short_id(entry)))
-            continue
 
-        download_artifact(gitlab, entry, filename)
+    outcomes = _parallel.run(download_one, artifacts_lock, jobs)
+    check_entry_errors(artifacts_lock, outcomes)
+
+    apply_cache_budget()
 
 @main.command()
 @click.option('--keep-empty-dirs', '-k', default=False, is_flag=True, hidden=True, help='Do not prune empty directories.')
 @click.option('--json', '-j', 'output_json', default=False, is_flag=True, help='Output artifact information to JSON')
-def install(keep_empty_dirs, output_json):
+@click.option('--jobs', default=1, metavar='N', type=click.IntRange(min=1), help='Number of artifacts to download and files to extract in parallel')
+@click.option('--link', default=False, is_flag=True, help='Extract archives once into the cache and install reflinks or hard links of the extracted files')
+@click.option('--force', default=False, is_flag=True, help='Install all files, even if they are up to date')
+def install(keep_empty_dirs, output_json, jobs, link, force):
     """Install artifacts to current directory."""
 
     if output_json:
         _termui.silent = True
 
-    gitlab = _gitlab.get()
+    gitlab = _gitlab.get(pool_size=jobs)
 
     artifacts_lock = _yaml.load(_paths.artifacts_lock_file)
     if not artifacts_lock:
         raise click.ClickException('No entries in %s file. Run "art update" first.' % _paths.artifacts_lock_file)
 
+    # Files recorded in the install state are skipped if their target didn't change
+    state_file = _paths.statefile(_paths.artifacts_lock_file)
+    previous_state = _install.load_state(state_file)
+    state = {} if force else previous_state
+    installed = {}
+
+    # Outdated files of the entries that share an archive are installed together,
+    # so that the archive is opened once and each of its members read once. This
+    # changes the order of the writes, so it relies on each target being written
+    # by a single file, the last one of the lock file.
+    pending = {}
+    entry_files = []
     for entry in artifacts_lock:
         # The list of matching files is recorded by art update, but older artifacts.lock.yml
         # files may be missing this attribute. Create it now, if necessary.
@@ -401,31 +889,62 @@ def install(keep_empty_dirs, output_json):
         # --keep-empty-dirs is a deprecated install option, as it has moved to "art update". If
         # a user specified it here, they may be expecting an older art version and may not have included
         # the option during "art update". Rebuild the files list to ensure the option isn't ignored.
-        files = entry.get('files', None)
-        if not files or keep_empty_dirs:
-            files = get_files_for_entry(gitlab, entry, keep_empty_dirs)
-
-        with open_install_source(gitlab, entry) as (artifact_file, archive):
-            permissions = {}
-            for file_spec in files:
-                filepath, target = next(iter(file_spec.items()))
-                target, filemode = _install.install(artifact_file, archive, filepath, target)
-
-                # File permissions are applied in a second pass. This prevents restrictive
-                # permissions from preventing extraction (e.g. a non-empty, read-only directory)
-                # without requiring depth-first traversal
-                permissions[target] = filemode
-
-                filemode_str = '   ' + stat.filemode(filemode)
-                request_path = canonical_request_path(entry, filepath)
-                _termui.echo('* install: %s => %s%s' % (request_path, target, filemode_str))
-
-            for target, filemode in permissions.items():
-                os.chmod(target, filemode)
+        files = get_entry_files(entry)
+        if files is None or keep_empty_dirs:
+            files = [next(iter(file_spec.items())) for file_spec in get_files_for_entry(gitlab, entry, keep_empty_dirs)]
+        entry_files.append(tuple(files))
+
+    # When several files are installed to the same target, the last one in the lock file wins.
+    # Only that file is checked and installed, so the target doesn't flip between them.
+    writers = {}
+    for index, files in enumerate(entry_files):
+        for position, (_, target) in enumerate(files):
+            writers[target] = (index, position)
+
+    for index, (entry, files) in enumerate(zip(artifacts_lock, entry_files)):
+        files = [(filepath, target) for position, (filepath, target) in enumerate(files)
+                 if writers[target] == (index, position)]
+
+        name = artifact_name(entry)
+        outdated = []
+        uptodate = 0
+        with _timings.phase('check', entry):
+            for filepath, target in files:
+                record = state.get(target, None)
+                if _install.is_installed(record, [name, filepath], target):
+                    installed[target] = record
+                    uptodate += 1
+                else:
+                    outdated.append((filepath, target))
+
+        if uptodate:
+            _termui.echo('* %s: %s => %d file(s) up to date' % (entry['project'], get_short_id(entry), uptodate))
+        if outdated:
+            pending.setdefault((name, entry.get('extract', True)), (entry, []))[1].extend(outdated)
+
+    # Fetch missing artifacts up front so the downloads can run concurrently
+    if jobs > 1:
+        entries = [entry for entry, _ in pending.values()]
+        outcomes = _parallel.run(lambda entry: fetch_artifact(gitlab, entry), entries, jobs)
+        check_entry_errors(entries, outcomes)
+
+    for entry, outdated in pending.values():
+        installed.update(install_files(gitlab, entry, outdated, link, jobs))
+
+    # Remove the files that were installed before, but are no longer in the lock file.
+    # Reverse order removes the contents of a directory before the directory itself.
+    for target in sorted(set(previous_state) - set(installed), reverse=True):
+        if os.path.lexists(target):
+            _paths.remove(target)
+            _termui.echo('* removed: %s' % (target,))
+
+    _install.save_state(state_file, installed)
+
+    _cache.flush()
+    apply_cache_budget()
 
     if output_json:
-        json.dump(artifacts_lock, sys.stdout, indent=2)
-        sys.stdout.write(os.linesep)
+        dump_json(artifacts_lock)
 
 def remove_installed_files(artifacts_lock, dry_run):
     """Remove files installed via art install"""
@@ -435,15 +954,14 @@ def remove_installed_files(artifacts_lock, dry_run):
     action = "would be removed" if dry_run else "removed"
     for entry in artifacts_lock:
         project = entry.get('project')
-        files = entry.get('files', None)
+        files = get_entry_files(entry)
 
         # Build file list if the lock file was created from older art
-        if not files:
+        if files is None:
             gitlab = _gitlab.get()
-            files = get_files_for_entry(gitlab, entry, False)
+            files = [next(iter(file_spec.items())) for file_spec in get_files_for_entry(gitlab, entry, False)]
 
-        for file_spec in files:
-            target = next(iter(file_spec.values()))
+        for _, target in files:
             if not os.path.exists(target):
                 continue
 
@@ -460,17 +978,38 @@ def clean(dry_run):
         raise click.ClickException('No entries in %s file. Run "art update" first.' % _paths.artifacts_lock_file)
 
     remove_installed_files(artifacts_lock, dry_run)
+    if not dry_run:
+        _paths.remove(_paths.statefile(_paths.artifacts_lock_file))
 
-@main.group()
-def cache():
+@main.group(invoke_without_command=True)
+@click.option('--rebuild-index', default=False, is_flag=True, help='Rebuild the index of cached files from the files on disk')
+@click.pass_context
+def cache(ctx, rebuild_index):
     """Inspect and manage the artifact cache"""
-    pass
+    if rebuild_index:
+        _cache.rebuild_index()
+    elif ctx.invoked_subcommand is None:
+        _termui.echo(ctx.get_help())
+
+def format_size(size, human_readable):
+    """Format a size in bytes for display"""
+    if not human_readable:
+        return str(size)
+
+    units = ['B', 'K', 'M', 'G', 'T', 'P']
+    unit = int(math.log2(size) // math.log2(1024)) if size else 0
+    return '{:0.1f}{}'.format(size / (1024 ** unit), units[unit])
 
 @cache.command()
 @click.option('--sort-size', '-s', default=False, is_flag=True, help='Sort results by size')
 @click.option('--human-readable', '-h', default=False, is_flag=True, help='Print sizes with units rather than bytes')
 def list(sort_size, human_readable):
-    """List projects with cached artifacts and their size"""
+    """List projects with cached artifacts and their size
+
+    SIZE adds up the size of every cached artifact, while DISK counts
+    identical artifacts only once. The TOTAL row counts artifacts shared
+    between projects once.
+    """
     archives = _cache.list()
 
     sort_key = lambda item: item[0]
@@ -478,31 +1017,23 @@ def list(sort_size, human_readable):
         sort_key = lambda item: item[1]['size']
     sorted_archives = sorted(archives.items() , key=sort_key, reverse=sort_size)
 
-    # convert sizes as string
-    for project in archives:
-        size = archives[project]['size']
-        if human_readable:
-            units = ['B', 'K', 'M', 'G', 'T', 'P']
-            unit = int(math.log2(size) // math.log2(1024))
-            archives[project]['size'] = '{:0.1f}{}'.format(size / (1024 ** unit), units[unit])
-        else:
-            archives[project]['size'] = str(size)
+    rows = [('PROJECT', 'SIZE', 'DISK')]
+    for project, archive in sorted_archives:
+        rows.append((project,
+                     format_size(archive['size'], human_readable),
+                     format_size(archive['disk'], human_readable)))
+    total_size = sum(archive['size'] for archive in archives.values())
+    rows.append(('TOTAL',
+                 format_size(total_size, human_readable),
+                 format_size(_cache.disk_usage(), human_readable)))
 
     # calculate column sizes for justification
-    column_sizes = [len('PROJECT'), len('SIZE')]
-    for project in archives:
-        name_len = len(project)
-        if name_len > column_sizes[0]:
-            column_sizes[0] = name_len + 1
-        size_len = len(archives[project]['size'])
-        if size_len > column_sizes[1]:
-            column_sizes[1] = size_len + 1
-
-    _termui.echo("PROJECT".ljust(column_sizes[0]), nl=False)
-    _termui.echo("SIZE".rjust(column_sizes[1]))
-    for project in dict(sorted_archives):
+    column_sizes = [max(len(row[column]) for row in rows) + 1 for column in range(3)]
+
+    for project, size, disk in rows:
         _termui.echo(project.ljust(column_sizes[0]), nl=False)
-        _termui.echo(archives[project]['size'].rjust(column_sizes[1]))
+        _termui.echo(size.rjust(column_sizes[1]), nl=False)
+        _termui.echo(disk.rjust(column_sizes[2]))
 
 @cache.command()
 @click.argument('patterns', metavar='PATTERN', nargs=-1)
@@ -529,7 +1060,28 @@ def purge(patterns, dry_run):
 
     action = "would be removed" if dry_run else "removed"
     for project in set(to_remove):
-        for filepath in archives[project]['files']:
+        for filename in archives[project]['files']:
             if not dry_run:
-                _paths.remove(filepath)
-            _termui.echo('* %s: %s => %s.' % (project, os.path.basename(filepath), action))
+                # artifacts being downloaded or installed are left alone
+                with _cache.lock(filename, blocking=False) as locked:
+                    if not locked:
+                        _termui.echo('* %s: %s => in use, skipped.' % (project, os.path.basename(filename)))
+                        continue
+                    _cache.remove(filename)
+            _termui.echo('* %s: %s => %s.' % (project, os.path.basename(filename), action))
+
+    if not dry_run:
+        _cache.prune()
+
+@cache.command()
+@click.option('--max-size', metavar='SIZE', callback=parse_option(_config.parse_size), help='Evict least recently used artifacts until the cache fits in SIZE, e.g. 20G')
+@click.option('--max-age', metavar='AGE', callback=parse_option(_config.parse_duration), help='Evict artifacts unused for longer than AGE, e.g. 30d')
+@click.option('-d', '--dry-run', default=False, is_flag=True, help='Report artificats that would be removed without removing them')
+def gc(max_size, max_age, dry_run):
+    """Evict least recently used artifacts. Limits default to the cache_max_size and cache_max_age settings."""
+    if max_size is None and max_age is None:
+        max_size, max_age = _config.cache_budget(_config.load())
+        if max_size is None and max_age is None:
+            raise click.UsageError('No cache budget. Use --max-size or --max-age, or set cache_max_size or cache_max_age in the configuration.')
+
+    evict_cached_artifacts(max_size, max_age, dry_run)
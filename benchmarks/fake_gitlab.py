@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+A stand-in for the GitLab server, implementing the API endpoints used by art
+
+One project has a pipeline with a successful job, a repository archive and a
+generic package. The job artifacts and the repository archive are ZIP files
+generated with the given number of members and total size. Files are served
+from disk, with support for range requests.
+
+Usage: python fake_gitlab.py --dir DIR [--port PORT] [--members N] [--size BYTES] [--stored]
+                             [--fail-every N [--fail-status STATUS] [--retry-after SECONDS]]
+
+With --fail-every, every Nth request fails with the given status, to test
+how art copes with an overloaded server. The server prints the URL it
+listens on once it's ready.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+PROJECT_ID = 1
+PROJECT_PATH = 'bench/project'
+PIPELINE_ID = 100
+JOB_ID = 1000
+JOB_NAME = 'build'
+COMMIT = hashlib.sha1(b'bench').hexdigest()
+PACKAGE_ID = 10
+PACKAGE_NAME = 'firmware'
+PACKAGE_FILE_ID = 20
+PACKAGE_FILE_NAME = 'firmware.bin'
+
+
+def random_bytes(rnd, size):
+    return rnd.getrandbits(size * 8).to_bytes(size, 'little')
+
+def make_archive(path, members, size, stored, prefix=''):
+    """Write a ZIP file with `members` files of random data adding up to `size` bytes"""
+    rnd = random.Random(members * 7919 + size)
+    member_size = max(size // max(members, 1), 1)
+    compression = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(path, 'w', compression) as archive:
+        for index in range(members):
+            name = '{}dir{}/file{}.bin'.format(prefix, index % 100, index)
+            archive.writestr(name, random_bytes(rnd, member_size))
+
+def make_blob(path, size):
+    rnd = random.Random(size)
+    with open(path, 'wb') as stream:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 1024)
+            stream.write(random_bytes(rnd, chunk))
+            remaining -= chunk
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    fail_every = 0
+    fail_status = 429
+    retry_after = None
+    requests = 0
+    requests_guard = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if not match.group(1):
+                start = max(size - int(match.group(2)), 0)
+            else:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as stream:
+            self.wfile.flush()
+            self.connection.sendfile(stream, start, end - start + 1)
+
+    def inject_failure(self):
+        """Fail every fail_every-th request, like a server under heavy load"""
+        if not self.fail_every:
+            return False
+
+        with self.requests_guard:
+            Handler.requests += 1
+            if Handler.requests % self.fail_every:
+                return False
+
+        body = b'{"message": "injected failure"}'
+        self.send_response(self.fail_status)
+        if self.retry_after is not None:
+            self.send_header('Retry-After', str(self.retry_after))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def do_GET(self):
+        if self.inject_failure():
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        match = re.fullmatch(r'/api/v4/projects/([^/]+)(/.*)?', url.path)
+        if not match or unquote(match.group(1)) not in (PROJECT_PATH, str(PROJECT_ID)):
+            return self.send_json({'message': '404 Not Found'}, 404)
+
+        route = match.group(2) or ''
+        if route == '':
+            return self.send_json({'id': PROJECT_ID, 'path': PROJECT_PATH.split('/')[-1],
+                                   'path_with_namespace': PROJECT_PATH})
+        if route == '/pipelines':
+            return self.send_json([{'id': PIPELINE_ID, 'sha': COMMIT, 'ref': query.get('ref', [''])[0],
+                                    'status': 'success'}])
+        if route == '/pipelines/{}/jobs'.format(PIPELINE_ID):
+            return self.send_json([{'id': JOB_ID, 'name': JOB_NAME, 'status': 'success',
+                                    'artifacts': [{'file_type': 'archive', 'filename': 'artifacts.zip',
+                                                   'size': os.path.getsize(self.files['job'])}]}])
+        if route == '/jobs/{}/artifacts'.format(JOB_ID):
+            return self.send_file(self.files['job'])
+        if re.fullmatch(r'/repository/(commits|tags)/[^/]+', route):
+            return self.send_json({'id': COMMIT, 'name': unquote(route.split('/')[-1]), 'commit': {'id': COMMIT}})
+        if route == '/repository/archive.zip':
+            return self.send_file(self.files['repository'])
+        if route == '/packages':
+            return self.send_json([{'id': PACKAGE_ID, 'name': PACKAGE_NAME, 'version': query['package_version'][0]}])
+        if route == '/packages/{}/package_files'.format(PACKAGE_ID):
+            return self.send_json([{'id': PACKAGE_FILE_ID, 'file_name': PACKAGE_FILE_NAME}])
+        if re.fullmatch(r'/packages/generic/[^/]+/[^/]+/{}'.format(PACKAGE_FILE_NAME), route):
+            return self.send_file(self.files['package'])
+
+        return self.send_json({'message': '404 Not Found'}, 404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake GitLab API for benchmarks')
+    parser.add_argument('--dir', required=True, help='Directory for the generated files')
+    parser.add_argument('--port', type=int, default=0, help='Port to listen on, a free port by default')
+    parser.add_argument('--members', type=int, default=1000, help='Number of files in each archive')
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024, help='Total size of the files in each archive')
+    parser.add_argument('--stored', action='store_true', help='Store archive members without compression')
+    parser.add_argument('--fail-every', type=int, default=0, metavar='N', help='Fail every Nth request')
+    parser.add_argument('--fail-status', type=int, default=429, help='HTTP status of failed requests')
+    parser.add_argument('--retry-after', type=int, metavar='SECONDS', help='Retry-After header of failed requests')
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    Handler.files = {
+        'job': os.path.join(args.dir, 'artifacts.zip'),
+        'repository': os.path.join(args.dir, 'repository.zip'),
+        'package': os.path.join(args.dir, PACKAGE_FILE_NAME),
+    }
+    make_archive(Handler.files['job'], args.members, args.size, args.stored)
+    make_archive(Handler.files['repository'], args.members, args.size, args.stored, prefix='project-main-{}/'.format(COMMIT))
+    make_blob(Handler.files['package'], args.size)
+    Handler.fail_every = args.fail_every
+    Handler.fail_status = args.fail_status
+    Handler.retry_after = args.retry_after
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print('http://127.0.0.1:{}'.format(server.server_address[1]), flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
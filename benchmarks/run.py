@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Time art update, download and install end to end against a local fake GitLab server
+
+Each scenario runs art from this source tree in a fresh process, with a cold
+or a warm cache, and is repeated to report the fastest and median times.
+The results are printed as JSON, to compare them over time:
+
+    python benchmarks/run.py --members 10000 --size 1000000000 > results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run art with a configuration file outside the user's configuration directory
+ART = ('import sys; from art import _paths; _paths.config_file = sys.argv.pop(1); '
+       'from art.command_line import main; main(prog_name="art")')
+
+ARTIFACTS_YML = '''\
+- project: bench/project
+  ref: main
+  job: build
+  install:
+    .: out/job/
+- project: bench/project
+  ref: main
+  source: repository
+  install:
+    .: out/repository/
+- project: bench/project
+  ref: v1.0
+  source: generic-package
+  package: firmware
+  filename: firmware.bin
+  extract: no
+  install:
+    .: out/package/
+'''
+
+
+class Workspace():
+    """A project directory, configuration and cache for art, in a temporary directory"""
+
+    def __init__(self, root, gitlab_url, jobs):
+        self.project = os.path.join(root, 'project')
+        self.cache = os.path.join(root, 'cache')
+        self.config = os.path.join(root, 'config.yml')
+        self.jobs = jobs
+
+        os.makedirs(self.project)
+        with open(os.path.join(self.project, 'artifacts.yml'), 'w') as stream:
+            stream.write(ARTIFACTS_YML)
+        with open(self.config, 'w') as stream:
+            stream.write('gitlab_url: {}\ntoken_type: private\ntoken: benchmark\n'.format(gitlab_url))
+
+    def art(self, *args):
+        """Run art, and return its --timings report when it can be part of the JSON output"""
+        command = list(args)
+        if self.jobs > 1:
+            command += ['--jobs', str(self.jobs)]
+
+        with_report = args[0] in ('update', 'install')
+        if with_report:
+            command = ['--timings'] + command + ['--json']
+
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        result = subprocess.run([sys.executable, '-c', ART, self.config, '-C', self.project, '-c', self.cache] + command,
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError('art {} failed:\n{}'.format(' '.join(args), result.stderr))
+
+        return json.loads(result.stdout)['timings'] if with_report else None
+
+    def clear_cache(self):
+        shutil.rmtree(self.cache, ignore_errors=True)
+
+    def clear_install(self):
+        shutil.rmtree(os.path.join(self.project, 'out'), ignore_errors=True)
+        state = os.path.join(self.project, '.artifacts.lock.yml.state')
+        if os.path.exists(state):
+            os.remove(state)
+
+
+# name, command, preparation before each run
+SCENARIOS = [
+    ('update-cold', ['update'], lambda ws: ws.clear_cache()),
+    ('update-warm', ['update'], lambda ws: None),
+    ('download-cold', ['download'], lambda ws: ws.clear_cache()),
+    ('download-warm', ['download'], lambda ws: None),
+    ('install-cold', ['install'], lambda ws: (ws.clear_cache(), ws.clear_install())),
+    ('install-warm', ['install'], lambda ws: ws.clear_install()),
+    ('install-up-to-date', ['install'], lambda ws: None),
+]
+
+
+def start_server(directory, args):
+    """Start the fake GitLab server and get its process and URL"""
+    command = [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_gitlab.py'), '--dir', directory,
+               '--members', str(args.members), '--size', str(args.size)]
+    if args.stored:
+        command.append('--stored')
+    if args.fail_every:
+        command += ['--fail-every', str(args.fail_every), '--fail-status', str(args.fail_status)]
+
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    url = server.stdout.readline().strip()
+    if not url:
+        server.wait()
+        raise RuntimeError('The fake GitLab server failed to start')
+
+    return server, url
+
+
+def run_scenario(workspace, command, prepare, repeat):
+    times = []
+    report = None
+    for _ in range(repeat):
+        prepare(workspace)
+        start = time.perf_counter()
+        report = workspace.art(*command)
+        times.append(time.perf_counter() - start)
+
+    result = {
+        'seconds': [round(seconds, 3) for seconds in times],
+        'min': round(min(times), 3),
+        'median': round(statistics.median(times), 3),
+    }
+    if report:
+        result['timings'] = report
+    return result
+
+
+def git_commit():
+    """Get the commit of the benchmarked source tree, if it's a git checkout"""
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark art against a local fake GitLab server')
+    parser.add_argument('--members', type=int, default=1000, help='Number of files in each archive')
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024, help='Total size of the files in each archive')
+    parser.add_argument('--stored', action='store_true', help='Store archive members without compression')
+    parser.add_argument('--fail-every', type=int, default=0, metavar='N', help='Make the server fail every Nth request')
+    parser.add_argument('--fail-status', type=int, default=429, help='HTTP status of failed requests')
+    parser.add_argument('--jobs', type=int, default=1, help='Value of the --jobs option of art')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each scenario')
+    parser.add_argument('--scenario', action='append', choices=[name for name, _, _ in SCENARIOS],
+                        help='Scenario to run, all of them by default. Can be repeated.')
+    parser.add_argument('--output', '-o', help='Write the results to a file instead of standard output')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='art-bench-')
+    server = None
+    try:
+        server, url = start_server(os.path.join(root, 'server'), args)
+        workspace = Workspace(os.path.join(root, 'client'), url, args.jobs)
+
+        # later scenarios need a lock file, even when only they are selected
+        workspace.art('update')
+
+        results = {}
+        for name, command, prepare in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            print('* {}...'.format(name), file=sys.stderr)
+            results[name] = run_scenario(workspace, command, prepare, args.repeat)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(root, ignore_errors=True)
+
+    output = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': git_commit(),
+        },
+        'parameters': {
+            'members': args.members,
+            'size': args.size,
+            'stored': args.stored,
+            'jobs': args.jobs,
+            'fail_every': args.fail_every,
+            'fail_status': args.fail_status,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(output, stream, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write(os.linesep)
+
+
+if __name__ == '__main__':
+    main()